@@ -0,0 +1,194 @@
+"""Cache backend shared by every worker process, stored in a local SQLite file.
+
+granian runs several worker processes: LocMemCache gives each of them its own
+copy, so a value invalidated in one worker stays stale in the others. This
+backend keeps the entries in a WAL-mode SQLite database next to the app
+database, which every worker on the host can read concurrently, without
+running an external cache service.
+"""
+
+import pickle
+import sqlite3
+import threading
+import time
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires REAL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+"""
+
+
+class SQLiteCache(BaseCache):
+    pickle_protocol = pickle.HIGHEST_PROTOCOL
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self.location = str(location)
+        self.local = threading.local()
+        self.cull_every = params.get("OPTIONS", {}).get("CULL_EVERY", 100)
+        self.writes = 0
+
+    @property
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.location, timeout=5, isolation_level=None, check_same_thread=False
+            )
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute("PRAGMA synchronous = NORMAL")
+            connection.executescript(SCHEMA)
+            self.local.connection = connection
+        return connection
+
+    def get_expiry(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        return None if timeout is None else time.time() + timeout
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute(
+            """
+            INSERT INTO cache (key, value, expires) VALUES (?, ?, ?)
+            ON CONFLICT (key) DO UPDATE SET
+                value = excluded.value, expires = excluded.expires
+            WHERE cache.expires IS NOT NULL AND cache.expires <= ?
+            """,
+            (key, self.dumps(value), self.get_expiry(timeout), time.time()),
+        )
+        self.maybe_cull()
+        return cursor.rowcount == 1
+
+    def get(self, key, default=None, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self.connection.execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return default if row is None else pickle.loads(row[0])  # nosec B301
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            (key, self.dumps(value), self.get_expiry(timeout)),
+        )
+        self.maybe_cull()
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute(
+            """
+            UPDATE cache SET expires = ?
+            WHERE key = ? AND (expires IS NULL OR expires > ?)
+            """,
+            (self.get_expiry(timeout), key, time.time()),
+        )
+        return cursor.rowcount == 1
+
+    def delete(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        cursor = self.connection.execute("DELETE FROM cache WHERE key = ?", (key,))
+        return cursor.rowcount == 1
+
+    def has_key(self, key, version=None):
+        key = self.make_and_validate_key(key, version=version)
+        row = self.connection.execute(
+            "SELECT 1 FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+            (key, time.time()),
+        ).fetchone()
+        return row is not None
+
+    def incr(self, key, delta=1, version=None):
+        """Atomically increment a stored integer, as seen by every worker"""
+        key = self.make_and_validate_key(key, version=version)
+        connection = self.connection
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires IS NULL OR expires > ?)",
+                (key, time.time()),
+            ).fetchone()
+            if row is None:
+                raise ValueError(f"Key '{key}' not found.")
+            value = pickle.loads(row[0]) + delta  # nosec B301
+            connection.execute(
+                "UPDATE cache SET value = ? WHERE key = ?", (self.dumps(value), key)
+            )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return value
+
+    def get_many(self, keys, version=None):
+        key_map = {
+            self.make_and_validate_key(key, version=version): key for key in keys
+        }
+        if not key_map:
+            return {}
+        placeholders = ", ".join("?" * len(key_map))
+        rows = self.connection.execute(
+            f"""
+            SELECT key, value FROM cache
+            WHERE key IN ({placeholders}) AND (expires IS NULL OR expires > ?)
+            """,  # nosec B608
+            (*key_map, time.time()),
+        ).fetchall()
+        return {key_map[key]: pickle.loads(value) for key, value in rows}  # nosec B301
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_expiry(timeout)
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+            [
+                (
+                    self.make_and_validate_key(key, version=version),
+                    self.dumps(value),
+                    expires,
+                )
+                for key, value in data.items()
+            ],
+        )
+        self.maybe_cull()
+        return []
+
+    def delete_many(self, keys, version=None):
+        self.connection.executemany(
+            "DELETE FROM cache WHERE key = ?",
+            [(self.make_and_validate_key(key, version=version),) for key in keys],
+        )
+
+    def clear(self):
+        self.connection.execute("DELETE FROM cache")
+
+    def close(self, **kwargs):
+        # Connections are per thread and reused across requests on purpose
+        pass
+
+    def dumps(self, value):
+        return pickle.dumps(value, self.pickle_protocol)
+
+    def maybe_cull(self):
+        """Every `cull_every` writes, drop expired entries and trim to MAX_ENTRIES"""
+        self.writes += 1
+        if self.writes % self.cull_every:
+            return
+        connection = self.connection
+        connection.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        (count,) = connection.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count > self._max_entries:
+            connection.execute(
+                """
+                DELETE FROM cache WHERE key IN (
+                    SELECT key FROM cache ORDER BY expires IS NULL, expires LIMIT ?
+                )
+                """,
+                (count // self._cull_frequency,),
+            )
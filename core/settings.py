@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     "django.contrib.contenttypes",
     "django.contrib.sessions",
     "django.contrib.messages",
+    "whitenoise.runserver_nostatic",
     "django.contrib.staticfiles",
     # Third-party apps
     "allauth",
@@ -57,10 +58,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
+    "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # Right after authentication, so a profile covers the rest of the stack
+    "trantrac.profiling.ProfilingMiddleware",
     "allauth.account.middleware.AccountMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
@@ -98,23 +102,61 @@ WSGI_APPLICATION = "core.wsgi.application"
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.sqlite3",
+        "ENGINE": "core.sqlite3",
         "NAME": BASE_DIR / "db/db.sqlite3",
+        # Keep connections (and the PRAGMAs applied to them) across requests
+        "CONN_MAX_AGE": env.int("DB_CONN_MAX_AGE", default=600),
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS": {
             "transaction_mode": "IMMEDIATE",
             "timeout": 5,  # seconds
-            "init_command": """
-                PRAGMA journal_mode=WAL;
-                PRAGMA synchronous=NORMAL;
-                PRAGMA mmap_size = 134217728;
-                PRAGMA journal_size_limit = 27103364;
-                PRAGMA cache_size=2000;
-            """,
+            "pragmas": {
+                # Only takes effect on new databases, or after a VACUUM (see
+                # compact_category_usage --vacuum)
+                "auto_vacuum": "INCREMENTAL",
+                "journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                "mmap_size": env.int("SQLITE_MMAP_SIZE", default=134217728),
+                "journal_size_limit": 27103364,
+                # negative values are KiB rather than pages
+                "cache_size": -env.int("SQLITE_CACHE_SIZE_KIB", default=8000),
+            },
+            "maintenance_interval": 3600,  # seconds between PRAGMA optimize
         },
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+
+# Both caches live in SQLite files shared by every granian worker, so a value
+# set or invalidated by one worker is immediately visible to the others
+CACHES = {
+    "default": {
+        "BACKEND": "core.cache.SQLiteCache",
+        "LOCATION": BASE_DIR / "db/cache.sqlite3",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+    "sessions": {
+        "BACKEND": "core.cache.SQLiteCache",
+        "LOCATION": BASE_DIR / "db/sessions.sqlite3",
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
+}
+
+
+# Sessions and messages
+# Sessions are read from the cache and only written through to the database
+# when they change; messages live in a signed cookie and never touch the session.
+
+SESSION_ENGINE = env(
+    "SESSION_ENGINE", default="django.contrib.sessions.backends.cached_db"
+)
+SESSION_CACHE_ALIAS = "sessions"
+MESSAGE_STORAGE = "django.contrib.messages.storage.cookie.CookieStorage"
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 
@@ -153,6 +195,17 @@ STATICFILES_DIRS = [BASE_DIR / "static"]
 STATIC_ROOT = BASE_DIR / "staticfiles"
 STATIC_URL = "/static/"
 
+# collectstatic writes content-hashed copies of every file plus .gz and .br
+# variants; WhiteNoise serves the hashed ones with an immutable Cache-Control
+STORAGES = {
+    "default": {
+        "BACKEND": "django.core.files.storage.FileSystemStorage",
+    },
+    "staticfiles": {
+        "BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage",
+    },
+}
+
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
 
@@ -205,6 +258,18 @@ GOOGLE_SHEETS_CREDENTIALS = {
 GOOGLE_SHEETS_SPREADSHEET_ID = env("GOOGLE_SHEETS_SPREADSHEET_ID")
 SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
 
+# CATEGORY PREDICTOR
+CATEGORY_PREDICTOR_SNAPSHOT = BASE_DIR / "db/category_predictor.json"
+CATEGORY_PREDICTOR_SNAPSHOT_INTERVAL = 60  # seconds
+
+# HEALTH CHECKS
+# Seconds between the background calls /readyz uses to report on Google Sheets
+HEALTH_SHEETS_PROBE_INTERVAL = env.int("HEALTH_SHEETS_PROBE_INTERVAL", default=60)
+
+# CATEGORY USAGE
+# Uses older than this are folded into monthly totals by compact_category_usage
+CATEGORY_USAGE_RETENTION_DAYS = env.int("CATEGORY_USAGE_RETENTION_DAYS", default=90)
+
 # # MAIL
 # EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 
@@ -221,7 +286,6 @@ ANYMAIL = {
 
 if env("PRODUCTION"):  # pragma: no cover
     CSRF_TRUSTED_ORIGINS = env("CSRF_TRUSTED_ORIGINS").split(",")
-    MIDDLEWARE.insert(2, "whitenoise.middleware.WhiteNoiseMiddleware")
 
 # DaisyUI configuration (requires tailwind-cli-extra)
 TAILWIND_CLI_SRC_REPO = "dobicinaitis/tailwind-cli-extra"
@@ -229,7 +293,8 @@ TAILWIND_CLI_VERSION = "2.6.2"  # Contains Tailwind CSS 4.1.17 + DaisyUI 5.5.3
 TAILWIND_CLI_ASSET_NAME = "tailwindcss-extra"
 TAILWIND_CLI_USE_DAISY_UI = True
 # Use custom source CSS with DaisyUI and plugins
-TAILWIND_CLI_SRC_CSS = "static/css/source.css"
+# Kept outside STATICFILES_DIRS: the manifest storage can't resolve its @imports
+TAILWIND_CLI_SRC_CSS = "assets/css/source.css"
 
 # IGNORE TYPER DEPRECATION WARNING
 warnings.filterwarnings("ignore", category=DeprecationWarning, module="typer.core")
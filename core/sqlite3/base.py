@@ -0,0 +1,54 @@
+"""SQLite backend tuned for long-lived connections.
+
+Django's sqlite3 backend runs its init commands every time it opens a
+connection, which with the default CONN_MAX_AGE = 0 means on every request.
+This backend is meant to be used with a persistent CONN_MAX_AGE: PRAGMAs are
+given as a dict in OPTIONS["pragmas"] and applied once per connection, and
+connections that live long enough get periodic maintenance (query planner
+statistics and WAL checkpoints) that a short-lived connection never needs.
+"""
+
+import time
+
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    def get_connection_params(self):
+        kwargs = super().get_connection_params()
+        self.pragmas = kwargs.pop("pragmas", {})
+        self.maintenance_interval = kwargs.pop("maintenance_interval", 3600)
+        return kwargs
+
+    def get_new_connection(self, conn_params):
+        conn = super().get_new_connection(conn_params)
+        for name, value in self.pragmas.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        self.next_maintenance = time.monotonic() + self.maintenance_interval
+        return conn
+
+    def close_if_unusable_or_obsolete(self):
+        super().close_if_unusable_or_obsolete()
+        # Called at the start and end of every request: piggyback on it to run
+        # maintenance on connections that have been kept alive long enough
+        if (
+            self.connection is not None
+            and not self.in_atomic_block
+            and time.monotonic() >= self.next_maintenance
+        ):
+            self.run_maintenance()
+
+    def run_maintenance(self):
+        """Refresh planner statistics and move the WAL back into the database"""
+        self.next_maintenance = time.monotonic() + self.maintenance_interval
+        with self.wrap_database_errors:
+            self.connection.execute("PRAGMA optimize")
+            self.connection.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def _close(self):
+        if self.connection is not None:
+            try:
+                self.connection.execute("PRAGMA optimize")
+            except self.Database.Error:
+                pass
+        super()._close()
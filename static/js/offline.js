@@ -0,0 +1,150 @@
+// Offline-first entry: the transaction form is saved to an IndexedDB queue
+// and the queue is flushed in batches to the ingest endpoint, so saving never
+// waits on the network (or on Google Sheets). Queued rows carry a UUID the
+// server uses to recognise a batch it has already recorded.
+(() => {
+  const config = document.currentScript.dataset;
+  const DB_NAME = "trantrac";
+  const STORE = "queue";
+  const BATCH_SIZE = 50;
+  const RETRY_INTERVAL = 60000;
+
+  if ("serviceWorker" in navigator) {
+    navigator.serviceWorker.register(config.serviceWorkerUrl, { scope: "/" });
+  }
+  if (!("indexedDB" in window) || !window.crypto?.randomUUID) {
+    return;
+  }
+
+  function openDb() {
+    return new Promise((resolve, reject) => {
+      const request = indexedDB.open(DB_NAME, 1);
+      request.onupgradeneeded = () =>
+        request.result.createObjectStore(STORE, { keyPath: "id" });
+      request.onsuccess = () => resolve(request.result);
+      request.onerror = () => reject(request.error);
+    });
+  }
+
+  async function withStore(mode, callback) {
+    const db = await openDb();
+    return new Promise((resolve, reject) => {
+      const transaction = db.transaction(STORE, mode);
+      const request = callback(transaction.objectStore(STORE));
+      transaction.oncomplete = () => resolve(request?.result);
+      transaction.onerror = () => reject(transaction.error);
+    });
+  }
+
+  const enqueue = (row) => withStore("readwrite", (store) => store.put(row));
+  const queued = () => withStore("readonly", (store) => store.getAll());
+  const dequeue = (ids) =>
+    withStore("readwrite", (store) => ids.forEach((id) => store.delete(id)));
+
+  function csrfToken() {
+    const cookie = document.cookie
+      .split("; ")
+      .find((item) => item.startsWith("csrftoken="));
+    if (cookie) {
+      return cookie.split("=")[1];
+    }
+    return JSON.parse(document.body.getAttribute("hx-headers"))["X-CSRFToken"];
+  }
+
+  const TOAST_CLASSES = { success: "text-success", error: "text-error" };
+
+  function toast(text, level) {
+    const container = document.getElementById("messages");
+    const element = document.createElement("div");
+    element.className = "fixed inset-x-0 top-3";
+    element.innerHTML = `<div role="alert" class="flex items-center p-4 mx-auto w-full max-w-xs rounded-lg shadow-sm sm:max-w-sm md:max-w-lg lg:max-w-xl text-base-content bg-base-200"><span class="text-sm font-normal ${TOAST_CLASSES[level]}"></span></div>`;
+    element.querySelector("span").textContent = text;
+    container.appendChild(element);
+    setTimeout(() => element.remove(), 3000);
+  }
+
+  let flushing = false;
+
+  async function flush() {
+    if (flushing || !navigator.onLine) {
+      return;
+    }
+    flushing = true;
+    let created = 0;
+    let invalid = 0;
+    try {
+      const rows = await queued();
+      for (let start = 0; start < rows.length; start += BATCH_SIZE) {
+        const response = await fetch(config.ingestUrl, {
+          method: "POST",
+          credentials: "same-origin",
+          headers: {
+            "Content-Type": "application/json",
+            "X-CSRFToken": csrfToken(),
+          },
+          body: JSON.stringify({
+            transactions: rows.slice(start, start + BATCH_SIZE),
+          }),
+        });
+        if (!response.ok) {
+          break; // Keep the rows and retry later
+        }
+        const { results } = await response.json();
+        // Invalid rows would be rejected forever: drop them too
+        await dequeue(results.map((result) => result.id));
+        created += results.filter((r) => r.status === "created").length;
+        invalid += results.filter((r) => r.status === "invalid").length;
+      }
+    } catch {
+      // Network error: the rows stay queued for the next attempt
+    } finally {
+      flushing = false;
+    }
+    if (created > 1) {
+      toast(`${created} transazioni in coda sincronizzate`, "success");
+    }
+    if (invalid) {
+      toast(`${invalid} transazioni non valide scartate`, "error");
+    }
+  }
+
+  // Take over the submit of forms marked with data-offline-queue
+  document.addEventListener("htmx:confirm", (event) => {
+    const form = event.detail.elt;
+    if (!(form instanceof HTMLFormElement) || !form.dataset.offlineQueue) {
+      return;
+    }
+    event.preventDefault();
+    if (!form.reportValidity()) {
+      return;
+    }
+    const data = Object.fromEntries(new FormData(form));
+    enqueue({
+      id: crypto.randomUUID(),
+      date: data.date,
+      amount: data.amount,
+      description: data.description,
+      category: Number(data.category),
+      subcategory: Number(data.subcategory),
+      bank_account: data.bank_account ? Number(data.bank_account) : null,
+    })
+      .then(() => {
+        form.reset();
+        form.querySelector("[name=category]")?.dispatchEvent(new Event("change"));
+        document.getElementById("category_prediction")?.replaceChildren();
+        toast(
+          navigator.onLine
+            ? "Transazione aggiunta con successo"
+            : "Transazione salvata offline, verrà sincronizzata",
+          "success",
+        );
+        flush();
+      })
+      // IndexedDB unavailable (e.g. private browsing): submit as usual
+      .catch(() => event.detail.issueRequest(true));
+  });
+
+  window.addEventListener("online", flush);
+  setInterval(flush, RETRY_INTERVAL);
+  flush();
+})();
@@ -0,0 +1,122 @@
+// TranTrac service worker: keeps the entry form usable offline or on a slow
+// connection. Rendered by the `service_worker` view so the asset URLs below
+// are the hashed names of the current deploy.
+const CACHE = "trantrac-{{ version }}";
+const ASSETS = {{ assets|safe }};
+const INDEX_URL = {{ index_url|safe }};
+const CATEGORY_MAP_URL = {{ category_map_url|safe }};
+const SUBCATEGORIES_URL = {{ subcategories_url|safe }};
+// Past this, a page load falls back to the cached copy
+const NAVIGATION_TIMEOUT = 3000;
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches
+      .open(CACHE)
+      .then((cache) => cache.addAll(ASSETS))
+      .then(() => refresh(CATEGORY_MAP_URL).catch(() => null))
+      .then(() => self.skipWaiting()),
+  );
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches
+      .keys()
+      .then((keys) =>
+        Promise.all(
+          keys.filter((key) => key !== CACHE).map((key) => caches.delete(key)),
+        ),
+      )
+      .then(() => self.clients.claim()),
+  );
+});
+
+self.addEventListener("fetch", (event) => {
+  const request = event.request;
+  const url = new URL(request.url);
+  if (request.method !== "GET" || url.origin !== self.location.origin) {
+    return;
+  }
+
+  if (request.mode === "navigate") {
+    event.respondWith(navigate(request, url));
+  } else if (ASSETS.includes(url.pathname)) {
+    event.respondWith(
+      caches.match(request).then((cached) => cached || fetch(request)),
+    );
+  } else if (url.pathname === CATEGORY_MAP_URL) {
+    // Stale-while-revalidate: answer from the cache, refresh in background
+    const fresh = refresh(CATEGORY_MAP_URL);
+    event.respondWith(
+      caches.match(CATEGORY_MAP_URL).then((cached) => cached || fresh),
+    );
+    event.waitUntil(fresh.catch(() => null));
+  } else if (url.pathname === SUBCATEGORIES_URL) {
+    event.respondWith(
+      fetch(request).catch(() =>
+        subcategoryOptions(url.searchParams.get("category")),
+      ),
+    );
+  }
+});
+
+// Fetch and cache a response, unless it's an error or a (login) redirect
+async function refresh(request) {
+  const response = await fetch(request);
+  if (response.ok && !response.redirected) {
+    const cache = await caches.open(CACHE);
+    await cache.put(request, response.clone());
+  }
+  return response;
+}
+
+// The entry form is served from the network when it answers quickly, from
+// the cache otherwise; other pages only fall back to it when offline
+async function navigate(request, url) {
+  if (url.pathname !== INDEX_URL) {
+    return fetch(request).catch(
+      async () => (await caches.match(INDEX_URL)) || Response.error(),
+    );
+  }
+  // The navigation request itself, so a login redirect is followed normally
+  const network = refresh(request);
+  const timeout = new Promise((resolve) =>
+    setTimeout(resolve, NAVIGATION_TIMEOUT),
+  );
+  try {
+    const response = await Promise.race([network, timeout]);
+    if (response) {
+      return response;
+    }
+  } catch {
+    // Offline: fall back to the cached copy below
+  }
+  return (await caches.match(INDEX_URL)) || network;
+}
+
+// Build the subcategory <option>s from the cached category map
+async function subcategoryOptions(categoryId) {
+  const response = await caches.match(CATEGORY_MAP_URL);
+  const { categories } = response ? await response.json() : { categories: [] };
+  const category = categories.find((c) => String(c.id) === categoryId);
+  const options = ['<option value="">Seleziona sottocategoria</option>'];
+  for (const subcategory of category ? category.subcategories : []) {
+    options.push(
+      `<option value="${subcategory.id}">${escapeHtml(subcategory.name)}</option>`,
+    );
+  }
+  return new Response(options.join("\n"), {
+    headers: { "Content-Type": "text/html; charset=utf-8" },
+  });
+}
+
+function escapeHtml(text) {
+  return text.replace(
+    /[&<>"']/g,
+    (char) =>
+      ({ "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#39;" })[
+        char
+      ],
+  );
+}
@@ -1,7 +1,101 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.db import transaction as db_transaction
+from django.utils.functional import cached_property
 
-from trantrac.models import Category, Account, Subcategory
+from trantrac.models import (
+    Account,
+    Category,
+    CategoryUsage,
+    RecurringTransaction,
+    Subcategory,
+    queue_category_and_sub_for_sheet,
+)
+from trantrac.reconcile import reconcile_categories
 
-admin.site.register(Category)
-admin.site.register(Subcategory)
-admin.site.register(Account)
+
+class CappedCountPaginator(Paginator):
+    """Paginator that stops counting after `max_count` rows.
+
+    COUNT(*) reads the whole table on SQLite; past the cap the changelist
+    shows the first pages only, which is all anybody browses anyway.
+    """
+
+    max_count = 10000
+
+    @cached_property
+    def count(self):
+        return self.object_list.order_by()[: self.max_count].count()
+
+
+@admin.register(Category)
+class CategoryAdmin(admin.ModelAdmin):
+    list_display = ("name",)
+    search_fields = ("name",)
+    ordering = ("name",)
+
+
+@admin.register(Subcategory)
+class SubcategoryAdmin(admin.ModelAdmin):
+    list_display = ("name", "category")
+    list_select_related = ("category",)
+    search_fields = ("name", "category__name")
+    ordering = ("category__name", "name")
+    autocomplete_fields = ("category",)
+    exclude = ("skip_sheet_save",)
+    actions = ("send_to_sheet",)
+
+    @admin.action(description="Aggiungi al foglio CATEGORIE le sottocategorie mancanti")
+    def send_to_sheet(self, request, queryset):
+        # One read of the sheet and one append, whatever the selection
+        missing = set(reconcile_categories().missing)
+        pairs = [
+            pair
+            for pair in queryset.values_list("category__name", "name")
+            if pair in missing
+        ]
+        with db_transaction.atomic():
+            for category_name, name in pairs:
+                queue_category_and_sub_for_sheet(category_name, name)
+        self.message_user(
+            request,
+            f"{len(pairs)} sottocategorie aggiunte al foglio"
+            if pairs
+            else "Le sottocategorie selezionate sono già nel foglio",
+            messages.SUCCESS,
+        )
+
+
+@admin.register(Account)
+class AccountAdmin(admin.ModelAdmin):
+    list_display = ("name",)
+    search_fields = ("name",)
+    ordering = ("name",)
+
+
+@admin.register(CategoryUsage)
+class CategoryUsageAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "user", "category", "subcategory", "count")
+    list_select_related = ("user", "category", "subcategory")
+    autocomplete_fields = ("category", "subcategory")
+    search_fields = ("category__name", "subcategory__name")
+    paginator = CappedCountPaginator
+    # Skips the second COUNT(*) of the unfiltered table
+    show_full_result_count = False
+
+
+@admin.register(RecurringTransaction)
+class RecurringTransactionAdmin(admin.ModelAdmin):
+    list_display = (
+        "description",
+        "amount",
+        "category",
+        "frequency",
+        "interval",
+        "last_date",
+        "active",
+    )
+    list_filter = ("active", "frequency")
+    list_select_related = ("category",)
+    autocomplete_fields = ("category", "subcategory", "account")
+    readonly_fields = ("last_date",)
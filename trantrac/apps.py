@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class TrantracConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "trantrac"
+
+    def ready(self):
+        from trantrac import checks, signals  # noqa: F401
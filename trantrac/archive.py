@@ -0,0 +1,215 @@
+"""Move closed years out of the live USCITE/ENTRATE tabs into per-year tabs.
+
+The live tabs then only hold the open years, so the reads done on every save
+and the sheet's own recalculations stay proportional to a year of data. An
+archive run takes the same few requests however many rows move: the list of
+tabs, one read of the date columns and a single batchUpdate that creates the
+year tabs, copies the rows there and deletes them from the live tabs. The API
+applies a batchUpdate atomically, so a failed run leaves the sheet untouched.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction as db_transaction
+
+from trantrac.models import ArchivedYear, Transaction
+from trantrac.reconcile import SHEET_KINDS, cell_date, live_transactions, read_ranges
+from trantrac.sheets import a1_range, get_sheets_service
+
+
+def row_year(cells):
+    """Year of a sheet row from its date cell, None for headers and blanks"""
+    try:
+        return date.fromisoformat(cell_date(cells[0])).year
+    except (IndexError, ValueError):
+        return None
+
+
+def runs(rows):
+    """Group sorted row numbers into [first, last] runs of consecutive rows"""
+    result = []
+    for row in rows:
+        if result and result[-1][1] == row - 1:
+            result[-1][1] = row
+        else:
+            result.append([row, row])
+    return result
+
+
+def grid_range(sheet_id, first, last):
+    """Whole rows `first` to `last` (1-based, inclusive) of a tab"""
+    return {"sheetId": sheet_id, "startRowIndex": first - 1, "endRowIndex": last}
+
+
+def copy_rows(source, first, last, destination, start):
+    return {
+        "copyPaste": {
+            "source": grid_range(source, first, last),
+            "destination": grid_range(destination, start, start + last - first),
+            "pasteType": "PASTE_NORMAL",
+        }
+    }
+
+
+class ArchivePlan:
+    def __init__(self, before):
+        self.before = before
+        self.years = set()
+        # Live tab -> year -> rows of that year, in sheet order
+        self.rows = {sheet_name: defaultdict(list) for sheet_name in SHEET_KINDS}
+        # Live tab -> {row: (year, row in the year tab)}
+        self.moves = {sheet_name: {} for sheet_name in SHEET_KINDS}
+        self.requests = []
+
+    @property
+    def moved(self):
+        return sum(len(moves) for moves in self.moves.values())
+
+
+def plan_archive(before):
+    """Work out the batchUpdate moving the rows dated before year `before`"""
+    plan = ArchivePlan(before)
+    properties = (
+        get_sheets_service()
+        .spreadsheets()
+        .get(
+            spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+            fields="sheets(properties(sheetId,title,gridProperties(columnCount)))",
+        )
+        .execute()
+    )
+    tabs = {
+        sheet["properties"]["title"]: sheet["properties"]
+        for sheet in properties["sheets"]
+    }
+
+    live = list(SHEET_KINDS)
+    for sheet_name, values in zip(
+        live,
+        read_ranges([a1_range(sheet_name, "B:B") for sheet_name in live]),
+        strict=True,
+    ):
+        for row, cells in enumerate(values, start=1):
+            year = row_year(cells)
+            if year and year < before:
+                plan.rows[sheet_name][year].append(row)
+    plan.years = {year for rows in plan.rows.values() for year in rows}
+    if not plan.years:
+        return plan
+
+    # Year tabs left by an earlier run (e.g. rows typed in by hand since) are
+    # appended to, after their last row
+    existing = [
+        f"{sheet_name} {year}"
+        for sheet_name in live
+        for year in sorted(plan.years)
+        if f"{sheet_name} {year}" in tabs
+    ]
+    lengths = {}
+    if existing:
+        values = read_ranges([a1_range(tab, "A:B") for tab in existing])
+        lengths = {tab: len(rows) for tab, rows in zip(existing, values, strict=True)}
+
+    next_id = max(tab["sheetId"] for tab in tabs.values()) + 1
+    deletions = []
+    for sheet_name in live:
+        live_id = tabs[sheet_name]["sheetId"]
+        for year in sorted(plan.years):
+            rows = plan.rows[sheet_name][year]
+            tab = f"{sheet_name} {year}"
+            if tab in tabs:
+                tab_id, start = tabs[tab]["sheetId"], lengths[tab] + 1
+                if rows:
+                    plan.requests.append(
+                        {
+                            "appendDimension": {
+                                "sheetId": tab_id,
+                                "dimension": "ROWS",
+                                "length": len(rows),
+                            }
+                        }
+                    )
+            else:
+                # Both tabs are created even when empty: later entries for the
+                # year are written there
+                tab_id, start, next_id = next_id, 2, next_id + 1
+                column_count = tabs[sheet_name]["gridProperties"]["columnCount"]
+                plan.requests += [
+                    {
+                        "addSheet": {
+                            "properties": {
+                                "sheetId": tab_id,
+                                "title": tab,
+                                "gridProperties": {
+                                    "rowCount": len(rows) + 1,
+                                    "columnCount": column_count,
+                                    "frozenRowCount": 1,
+                                },
+                            }
+                        }
+                    },
+                    copy_rows(live_id, 1, 1, tab_id, 1),
+                ]
+            for first, last in runs(rows):
+                plan.requests.append(copy_rows(live_id, first, last, tab_id, start))
+                for offset, row in enumerate(range(first, last + 1)):
+                    plan.moves[sheet_name][row] = (year, start + offset)
+                start += last - first + 1
+
+        # Bottom-up, so each deletion leaves the indexes of the next ones valid
+        for first, last in reversed(runs(sorted(plan.moves[sheet_name]))):
+            deletions.append(
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": live_id,
+                            "dimension": "ROWS",
+                            "startIndex": first - 1,
+                            "endIndex": last,
+                        }
+                    }
+                }
+            )
+    plan.requests += deletions
+    return plan
+
+
+def archive_years(before):
+    """Archive every year before `before`, in the sheet and in the ledger"""
+    plan = plan_archive(before)
+    if not plan.years:
+        return plan
+
+    get_sheets_service().spreadsheets().batchUpdate(
+        spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+        body={"requests": plan.requests},
+    ).execute()
+
+    with db_transaction.atomic():
+        for sheet_name, moves in plan.moves.items():
+            moved_rows = sorted(moves)
+            transactions = list(
+                live_transactions(sheet_name)
+                .filter(sheet_row__isnull=False)
+                .only("date", "sheet_row")
+            )
+            for transaction in transactions:
+                if transaction.sheet_row in moves:
+                    year, row = moves[transaction.sheet_row]
+                    # A row out of place: let reconcile_sheet --locate find it
+                    transaction.sheet_row = (
+                        row if transaction.date.year == year else None
+                    )
+                else:
+                    # Shift up by the number of rows deleted above it
+                    transaction.sheet_row -= bisect_left(
+                        moved_rows, transaction.sheet_row
+                    )
+            Transaction.objects.bulk_update(transactions, ["sheet_row"], batch_size=500)
+        ArchivedYear.objects.bulk_create(
+            [ArchivedYear(year=year) for year in plan.years], ignore_conflicts=True
+        )
+    return plan
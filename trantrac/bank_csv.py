@@ -0,0 +1,136 @@
+"""Parsing of bank CSV exports.
+
+This module doesn't import Django: `parse_bank_file` runs in the worker
+processes of a pool (see `trantrac.utils.parse_bank_files`), which only
+import what they need to parse.
+"""
+
+import csv
+import zipfile
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO, TextIOWrapper
+
+CSV_DATE_FORMATS = ("%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d", "%d-%m-%Y", "%d.%m.%Y")
+
+IMPORT_COLUMNS = {
+    "Data operazione",
+    "Importo",
+    "Descrizione",
+    "Categoria",
+    "Sottocategoria",
+    "Codice identificativo",
+}
+
+# Limits on the CSV files read from an uploaded ZIP
+ZIP_MAX_FILES = 100
+ZIP_MAX_FILE_SIZE = 20 * 1024 * 1024
+# Limit on the size of the files of an upload, as sent
+UPLOAD_MAX_SIZE = 50 * 1024 * 1024
+# Limit on the uncompressed size of all the files of an upload, CSVs and ZIP
+# contents together: everything is held in memory while parsing
+UPLOAD_MAX_UNCOMPRESSED_SIZE = 100 * 1024 * 1024
+
+
+class CsvImportError(ValueError):
+    """A bank export that can't be imported, with a message for the user"""
+
+
+# An export has at most a few hundred distinct dates, repeated on many rows
+@lru_cache(maxsize=4096)
+def parse_csv_date(value):
+    """Parse a bank export date, returning None if no known format matches"""
+    value = value.strip()
+    for date_format in CSV_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_bank_csv(file):
+    """Parse a bank export (a binary file) into normalized rows.
+
+    Rows are (date, amount_cents, description, category, subcategory,
+    external_id) tuples, with negative amounts for expenses.
+    """
+    csv_reader = csv.DictReader(TextIOWrapper(file, encoding="utf-8"))
+
+    if missing_columns := IMPORT_COLUMNS - set(csv_reader.fieldnames or ()):
+        raise CsvImportError(
+            f"Il file CSV non contiene le seguenti colonne: {', '.join(missing_columns)}"
+        )
+
+    rows = []
+    for row in csv_reader:
+        if not any(row.values()) or any("Saldo" in value for value in row.values()):
+            continue
+
+        importo = row["Importo"].replace("+", "").strip()
+        try:
+            importo_float = float(importo.replace(".", "").replace(",", "."))
+        except ValueError:
+            raise CsvImportError(
+                "Il file CSV contiene valori non numerici nella colonna Importo."
+            ) from None
+
+        date = parse_csv_date(row["Data operazione"])
+        if date is None:
+            raise CsvImportError(
+                "Il file CSV contiene date non valide nella colonna Data operazione."
+            )
+
+        rows.append(
+            (
+                date,
+                round(importo_float * 100),
+                row["Descrizione"],
+                row["Categoria"],
+                row["Sottocategoria"],
+                row["Codice identificativo"],
+            )
+        )
+    return rows
+
+
+def parse_bank_file(name, data):
+    """Parse one file's content, returning (name, rows, error) instead of raising"""
+    try:
+        return name, parse_bank_csv(BytesIO(data)), None
+    except CsvImportError as e:
+        return name, [], str(e)
+    except UnicodeDecodeError:
+        return name, [], "Il file non è un CSV in formato UTF-8."
+    except csv.Error as e:
+        return name, [], f"Il file CSV non è valido: {e}"
+
+
+def expand_zip(name, data, max_size=UPLOAD_MAX_UNCOMPRESSED_SIZE):
+    """The CSV files inside a ZIP, as (name, data) pairs.
+
+    The sizes declared by the archive are checked before anything is
+    decompressed: `max_size` bounds their total.
+    """
+    try:
+        archive = zipfile.ZipFile(BytesIO(data))
+    except zipfile.BadZipFile:
+        raise CsvImportError("Il file ZIP non è valido.") from None
+    members = [
+        member
+        for member in archive.infolist()
+        if not member.is_dir()
+        and member.filename.lower().endswith(".csv")
+        and not member.filename.startswith("__MACOSX/")
+    ]
+    if len(members) > ZIP_MAX_FILES:
+        raise CsvImportError(f"Il file ZIP contiene più di {ZIP_MAX_FILES} file CSV.")
+    for member in members:
+        if member.file_size > ZIP_MAX_FILE_SIZE:
+            raise CsvImportError(f"{member.filename} è troppo grande.")
+    if sum(member.file_size for member in members) > max_size:
+        raise CsvImportError(f"Il contenuto di {name} è troppo grande.")
+    files = []
+    for member in sorted(members, key=lambda member: member.filename):
+        files.append((f"{name}/{member.filename}", archive.read(member)))
+    return files
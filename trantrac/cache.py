@@ -0,0 +1,46 @@
+from django.core.cache import cache
+
+# Namespaces of cached data, invalidated as a whole when the data changes
+CATEGORIES = "categories"
+ACCOUNTS = "accounts"
+QUICK_PICKS = "quick_picks"
+SPENDING = "spending"
+
+
+def generation(namespace):
+    """Current generation of a namespace, shared by every worker via the cache"""
+    key = f"generation:{namespace}"
+    current = cache.get(key)
+    if current is None:
+        cache.add(key, 1, timeout=None)
+        current = cache.get(key, 1)
+    return current
+
+
+def cached(namespace, key, compute, timeout=3600):
+    """Return the cached value of `compute()` for `key` within `namespace`.
+
+    Keys embed the namespace generation, so after `invalidate(namespace)` every
+    worker looks up fresh keys and the stale entries simply expire or get culled.
+    """
+    versioned_key = f"{namespace}:{generation(namespace)}:{key}"
+    value = cache.get(versioned_key)
+    if value is None:
+        value = compute()
+        cache.set(versioned_key, value, timeout=timeout)
+    return value
+
+
+def forget(namespace, *keys):
+    """Drop single keys of a namespace, leaving the rest of it cached"""
+    current = generation(namespace)
+    cache.delete_many([f"{namespace}:{current}:{key}" for key in keys])
+
+
+def invalidate(*namespaces):
+    """Bump the generation of the namespaces, for every worker at once"""
+    for namespace in namespaces:
+        try:
+            cache.incr(f"generation:{namespace}")
+        except ValueError:
+            cache.add(f"generation:{namespace}", 2, timeout=None)
@@ -0,0 +1,26 @@
+from django.core.checks import Error, Tags, register
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+
+@register(Tags.database)
+def check_fts_triggers(app_configs, databases, **kwargs):
+    """Full-text search silently misses rows if its triggers are gone"""
+    if not databases or "default" not in databases:
+        return []
+    executor = MigrationExecutor(connection)
+    if executor.migration_plan(executor.loader.graph.leaf_nodes()):
+        # Not migrated yet: the migrations create (or restore) the triggers
+        return []
+
+    from trantrac.utils import missing_fts_triggers
+
+    return [
+        Error(
+            f"Full-text search trigger {name} is missing",
+            hint="A migration rebuilt trantrac_transaction: recreate the triggers "
+            "of 0005 and rebuild trantrac_transaction_fts.",
+            id="trantrac.E001",
+        )
+        for name in missing_fts_triggers()
+    ]
@@ -1,10 +1,13 @@
-from datetime import datetime, timezone
+from datetime import UTC, datetime
+from decimal import Decimal
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import HTML, Button, Div, Field, Layout, Submit
 from django import forms
 from django.urls import reverse_lazy
 
+from trantrac.bank_csv import UPLOAD_MAX_SIZE
+from trantrac.cache import ACCOUNTS, cached
 from trantrac.models import Account, Category, Subcategory
 
 HTML_ADD_BUTTON = """
@@ -118,6 +121,19 @@ class DateInput(forms.widgets.DateInput):
         return value.strftime("%Y-%m-%d")
 
 
+def default_account(user):
+    """Bank account named after the user's display name, or the first one"""
+    display_name = user.display_name if user else ""
+    return cached(
+        ACCOUNTS,
+        f"default:{display_name}",
+        lambda: (
+            (display_name and Account.objects.filter(name=display_name).first())
+            or Account.objects.first()
+        ),
+    )
+
+
 class TransactionForm(forms.Form):
     amount = forms.DecimalField(max_digits=10, decimal_places=2, label="Importo")
     date = forms.DateField(widget=DateInput(), label="Data")
@@ -149,15 +165,8 @@ class TransactionForm(forms.Form):
         self.helper = FormHelper()
         self.helper.form_tag = False
         self.helper.label_class = "block text-base-content text-sm font-bold mb-2"
-        self.fields["date"].initial = datetime.now(timezone.utc)
-        # Set initial bank account based on user's display name
-        if user and user.display_name:
-            matching_account = Account.objects.filter(name=user.display_name).first()
-            self.fields["bank_account"].initial = (
-                matching_account or Account.objects.first()
-            )
-        else:
-            self.fields["bank_account"].initial = Account.objects.first()
+        self.fields["date"].initial = datetime.now(UTC)
+        self.fields["bank_account"].initial = default_account(user)
         self.fields["category"].empty_label = "Seleziona categoria"
         self.fields["subcategory"].empty_label = "Seleziona sottocategoria"
         # If category is selected, filter subcategories
@@ -194,7 +203,16 @@ class TransactionForm(forms.Form):
                     ),
                     css_class="flex flex-col md:flex-row gap-3 mb-3",
                 ),
-                Field("description", css_class="bg-base-200 dark:bg-base-300"),
+                Field(
+                    "description",
+                    css_class="bg-base-200 dark:bg-base-300",
+                    autocomplete="off",
+                    hx_get=reverse_lazy("predict_category"),
+                    hx_trigger="input changed delay:300ms",
+                    hx_target="#category_prediction",
+                    hx_swap="innerHTML",
+                ),
+                HTML('<div id="category_prediction"></div>'),
                 HTML(HTML_QUICK_CATEGORIES_START),
                 Div(
                     Field(
@@ -229,11 +247,212 @@ class TransactionForm(forms.Form):
                     "Aggiungi",
                     css_class="w-full mt-3",
                 ),
+                HTML(
+                    '<a href="{% url \'receipt\' %}" class="w-full mt-2 btn btn-ghost btn-sm">'
+                    "Scontrino con più righe</a>"
+                ),
                 x_data="{ hasCategory: false }",
             ),
         )
 
 
+class ReceiptForm(forms.Form):
+    """Fields shared by every row of a receipt"""
+
+    date = forms.DateField(widget=DateInput(), label="Data")
+    description = forms.CharField(max_length=200, label="Descrizione")
+    bank_account = forms.ModelChoiceField(
+        queryset=Account.objects.all(),
+        label="Conto",
+        widget=forms.HiddenInput(),
+    )
+
+    def __init__(self, *args, **kwargs):
+        user = kwargs.pop("user", None)
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = False
+        self.helper.label_class = "block text-base-content text-sm font-bold mb-2"
+        self.fields["date"].initial = datetime.now(UTC)
+        self.fields["bank_account"].initial = default_account(user)
+        self.helper.layout = Layout(
+            Div(
+                Field(
+                    "date",
+                    css_class="bg-base-200 dark:bg-base-300",
+                    wrapper_class="grow",
+                ),
+                Field(
+                    "description",
+                    css_class="bg-base-200 dark:bg-base-300",
+                    wrapper_class="grow",
+                    autocomplete="off",
+                ),
+                css_class="flex flex-col md:flex-row gap-3",
+            ),
+            Field("bank_account"),
+        )
+
+
+class PreloadedModelChoiceField(forms.ModelChoiceField):
+    """ModelChoiceField looking up submitted values in a dict of preloaded objects"""
+
+    objects = None
+
+    def to_python(self, value):
+        if self.objects is None or value in self.empty_values:
+            return super().to_python(value)
+        try:
+            return self.objects[int(value)]
+        except (KeyError, TypeError, ValueError):
+            raise forms.ValidationError(
+                self.error_messages["invalid_choice"], code="invalid_choice"
+            ) from None
+
+
+def clean_subcategory_of_category(form, cleaned_data):
+    """Reject a subcategory that doesn't belong to the chosen category"""
+    category = cleaned_data.get("category")
+    subcategory = cleaned_data.get("subcategory")
+    if category and subcategory and subcategory.category_id != category.pk:
+        form.add_error(
+            "subcategory",
+            forms.ValidationError(
+                form.fields["subcategory"].error_messages["invalid_choice"],
+                code="invalid_choice",
+            ),
+        )
+    return cleaned_data
+
+
+class ReceiptRowForm(forms.Form):
+    """One line of a receipt: an amount booked to its own category"""
+
+    amount = forms.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0.01"), label="Importo"
+    )
+    category = PreloadedModelChoiceField(
+        queryset=Category.objects.all().order_by("name"), label="Categoria"
+    )
+    subcategory = PreloadedModelChoiceField(
+        queryset=Subcategory.objects.none(), label="Sottocategoria"
+    )
+    note = forms.CharField(max_length=100, required=False, label="Nota")
+
+    def __init__(self, *args, categories=None, subcategories=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["category"].objects = categories
+        self.fields["subcategory"].objects = subcategories
+        self.fields["category"].empty_label = "Seleziona categoria"
+        self.fields["subcategory"].empty_label = "Seleziona sottocategoria"
+        self.fields["category"].widget.attrs.update(
+            {
+                "hx-get": reverse_lazy("load_subcategories"),
+                "hx-target": f"#id_{self.add_prefix('subcategory')}",
+                "hx-vals": 'js:{"category": event.target.value}',
+            }
+        )
+        try:
+            category_id = int(self.data.get(self.add_prefix("category")))
+            self.fields["subcategory"].queryset = Subcategory.objects.filter(
+                category_id=category_id
+            ).order_by("name")
+        except (ValueError, TypeError):
+            pass
+
+    def clean(self):
+        return clean_subcategory_of_category(self, super().clean())
+
+
+class BaseReceiptRowFormSet(forms.BaseFormSet):
+    """Load the categories picked in every row with two queries, not two per row"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = Category.objects.in_bulk(self.submitted_ids("category"))
+        self.subcategories = Subcategory.objects.in_bulk(
+            self.submitted_ids("subcategory")
+        )
+
+    def submitted_ids(self, field):
+        return {
+            int(value)
+            for key, value in self.data.items()
+            if key.startswith(f"{self.prefix}-")
+            and key.endswith(f"-{field}")
+            and value.isdigit()
+        }
+
+    def get_form_kwargs(self, index):
+        if not self.is_bound:
+            return {}
+        return {"categories": self.categories, "subcategories": self.subcategories}
+
+
+class ReceiptRowFormSetHelper(FormHelper):
+    form_tag = False
+    disable_csrf = True
+    form_show_labels = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.layout = Layout(
+            Div(
+                Field(
+                    "amount",
+                    css_class="bg-base-200 dark:bg-base-300",
+                    placeholder="Importo",
+                    step="0.01",
+                ),
+                Field("category", css_class="bg-base-200 dark:bg-base-300"),
+                Field("subcategory", css_class="bg-base-200 dark:bg-base-300"),
+                Field(
+                    "note",
+                    css_class="bg-base-200 dark:bg-base-300",
+                    placeholder="Nota (facoltativa)",
+                    autocomplete="off",
+                ),
+                css_class="grid grid-cols-2 gap-x-3 p-3 mb-3 rounded-lg border-2 border-gray-100 dark:border-base-300",
+            ),
+        )
+
+
+ReceiptRowFormSet = forms.formset_factory(
+    ReceiptRowForm,
+    formset=BaseReceiptRowFormSet,
+    extra=2,
+    min_num=1,
+    max_num=50,
+    validate_min=True,
+    validate_max=True,
+)
+
+
+class IngestTransactionForm(forms.Form):
+    """One transaction queued by the offline client, validated on ingest"""
+
+    id = forms.UUIDField()
+    date = forms.DateField()
+    amount = forms.DecimalField(
+        max_digits=10, decimal_places=2, min_value=Decimal("0.01")
+    )
+    description = forms.CharField(max_length=200)
+    category = PreloadedModelChoiceField(queryset=Category.objects.all())
+    subcategory = PreloadedModelChoiceField(queryset=Subcategory.objects.all())
+    bank_account = PreloadedModelChoiceField(
+        queryset=Account.objects.all(), required=False
+    )
+
+    def __init__(self, *args, categories, subcategories, accounts, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields["category"].objects = categories
+        self.fields["subcategory"].objects = subcategories
+        self.fields["bank_account"].objects = accounts
+
+    def clean(self):
+        return clean_subcategory_of_category(self, super().clean())
+
+
 class CategoryForm(forms.ModelForm):
     class Meta:
         model = Category
@@ -296,17 +515,46 @@ class SubcategoryForm(forms.ModelForm):
         )
 
 
+class MultipleFileInput(forms.ClearableFileInput):
+    allow_multiple_selected = True
+
+
+class MultipleFileField(forms.FileField):
+    """File field accepting several files, cleaned to a list"""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("widget", MultipleFileInput())
+        super().__init__(*args, **kwargs)
+
+    def clean(self, data, initial=None):
+        single_file_clean = super().clean
+        if isinstance(data, list | tuple):
+            return [single_file_clean(file, initial) for file in data]
+        return [single_file_clean(data, initial)]
+
+
 class CsvUploadForm(forms.Form):
-    csv_file = forms.FileField(
-        label="File CSV", help_text="Scarica il file nel formato csv a 1 colonna"
+    csv_file = MultipleFileField(
+        label="File CSV",
+        help_text=(
+            "Scarica i file nel formato csv a 1 colonna: puoi caricarne più di "
+            "uno, anche in un unico zip"
+        ),
+        widget=MultipleFileInput(attrs={"accept": ".csv,.zip"}),
     )
 
-    def clean_file(self):
-        file = self.cleaned_data.get("file")
-        ext = file.name.split(".")[-1].lower()
-        if ext not in ["csv"]:
-            raise forms.ValidationError("Il file deve essere in formato csv")
-        return file
+    def clean_csv_file(self):
+        files = self.cleaned_data.get("csv_file")
+        for file in files:
+            ext = file.name.split(".")[-1].lower()
+            if ext not in ["csv", "zip"]:
+                raise forms.ValidationError("I file devono essere in formato csv o zip")
+        # Checked on the upload, before anything is read into memory
+        if sum(file.size for file in files) > UPLOAD_MAX_SIZE:
+            raise forms.ValidationError(
+                f"I file caricati superano i {UPLOAD_MAX_SIZE // (1024 * 1024)} MB"
+            )
+        return files
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -334,3 +582,35 @@ class CsvUploadForm(forms.Form):
                 css_class="mt-4 flex justify-end gap-x-2",
             ),
         )
+
+
+class HistoryFilterForm(forms.Form):
+    account = forms.ModelChoiceField(
+        queryset=Account.objects.all().order_by("name"),
+        required=False,
+        label="Conto",
+        empty_label="Tutti i conti",
+    )
+    category = forms.ModelChoiceField(
+        queryset=Category.objects.all().order_by("name"),
+        required=False,
+        label="Categoria",
+        empty_label="Tutte le categorie",
+    )
+    date_from = forms.DateField(widget=DateInput(), required=False, label="Dal")
+    date_to = forms.DateField(widget=DateInput(), required=False, label="Al")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.helper = FormHelper()
+        self.helper.form_tag = False
+        self.helper.label_class = "block text-base-content text-sm font-bold mb-2"
+        self.helper.layout = Layout(
+            Div(
+                Field("account", wrapper_class="grow"),
+                Field("category", wrapper_class="grow"),
+                Field("date_from", wrapper_class="grow"),
+                Field("date_to", wrapper_class="grow"),
+                css_class="grid grid-cols-2 gap-3 md:grid-cols-4",
+            ),
+        )
@@ -0,0 +1,158 @@
+"""Probes behind the /readyz endpoint.
+
+Each probe is cheap enough to run every few seconds, except the Sheets one:
+a daemon thread per worker calls the API every SHEETS_PROBE_INTERVAL seconds
+and /readyz only reads its last result, so a hung Google call shows up as a
+stale probe instead of a hung health check.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+
+from trantrac.models import Transaction
+from trantrac.sheets import build_sheets_service
+
+logger = logging.getLogger(__name__)
+
+STARTED = time.monotonic()
+
+# Longest wait for the SQLite write lock before the database counts as locked
+WRITE_LOCK_TIMEOUT = 2  # seconds
+
+
+def uptime():
+    return round(time.monotonic() - STARTED)
+
+
+def database_probe():
+    """Time taken to get (and release at once) the SQLite write lock.
+
+    A separate connection, so the probe never waits on or holds a lock of the
+    request's own connection.
+    """
+    start = time.perf_counter()
+    try:
+        db = sqlite3.connect(
+            connection.settings_dict["NAME"],
+            timeout=WRITE_LOCK_TIMEOUT,
+            isolation_level=None,
+        )
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute("ROLLBACK")
+        finally:
+            db.close()
+    except sqlite3.Error as e:
+        return {"ok": False, "error": str(e)}
+    return {"ok": True, "write_lock_ms": round((time.perf_counter() - start) * 1000, 1)}
+
+
+def outbox_probe():
+    """Transactions not yet written to the sheet, by sync state"""
+    counts = dict(
+        Transaction.objects.exclude(sync_state=Transaction.SyncState.SYNCED)
+        .order_by()
+        .values_list("sync_state")
+        .annotate(count=Count("pk"))
+    )
+    return {
+        "pending": counts.get(Transaction.SyncState.PENDING, 0),
+        "failed": counts.get(Transaction.SyncState.FAILED, 0),
+    }
+
+
+class SheetsProbe:
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.result = {"ok": None}
+        self.checked = None
+
+    def ensure_started(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    # Until the first check returns, its age counts from here
+                    self.checked = time.monotonic()
+                    self.thread = threading.Thread(
+                        target=self.run, name="sheets-probe", daemon=True
+                    )
+                    self.thread.start()
+
+    def run(self):
+        # Its own service: the shared one's httplib2 connection is used by the
+        # request threads and isn't thread-safe
+        service = None
+        while True:
+            try:
+                service = service or build_sheets_service()
+            except Exception as e:  # noqa: BLE001 - reported, whatever it is
+                self.record({"ok": False, "error": type(e).__name__})
+            else:
+                self.check(service)
+            time.sleep(self.interval)
+
+    def record(self, result):
+        with self.lock:
+            self.result, self.checked = result, time.monotonic()
+
+    def check(self, service):
+        start = time.perf_counter()
+        try:
+            service.spreadsheets().get(
+                spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+                fields="spreadsheetId",
+            ).execute()
+        except Exception as e:  # noqa: BLE001 - reported, whatever it is
+            result = {"ok": False, "error": type(e).__name__}
+        else:
+            result = {
+                "ok": True,
+                "latency_ms": round((time.perf_counter() - start) * 1000),
+            }
+        self.record(result)
+
+    def status(self):
+        """The last result, with its age; stale once two checks were missed"""
+        self.ensure_started()
+        with self.lock:
+            result, checked = dict(self.result), self.checked
+        age = time.monotonic() - checked
+        result["age_s"] = round(age)
+        result["stale"] = age > 2 * self.interval + 30
+        return result
+
+
+sheets_probe = SheetsProbe(settings.HEALTH_SHEETS_PROBE_INTERVAL)
+
+
+def readiness():
+    """Everything /readyz reports, and whether the worker can serve requests"""
+    database = database_probe()
+    report = {
+        "database": database,
+        "sheets": sheets_probe.status(),
+        "uptime_s": uptime(),
+    }
+    if database["ok"]:
+        report["outbox"] = outbox_probe()
+    # Sheets being down degrades the app (entries wait in the outbox) but
+    # doesn't stop it from serving
+    sheets = report["sheets"]
+    if not database["ok"]:
+        report["status"] = "unavailable"
+    elif sheets["ok"] is False or sheets.get("stale"):
+        report["status"] = "degraded"
+    else:
+        report["status"] = "ok"
+    if report["status"] != "ok":
+        # Anonymous callers only get "fail": the details go to the logs
+        logger.warning("Readiness %s: %s", report["status"], report)
+    return database["ok"], report
@@ -0,0 +1,49 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from trantrac.archive import archive_years, plan_archive
+
+
+class Command(BaseCommand):
+    help = (
+        "Move the rows of closed years from the USCITE and ENTRATE tabs to "
+        "per-year tabs (e.g. 'USCITE 2024'), where later entries for those "
+        "years are written too"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--before",
+            type=int,
+            help="Archive the years before this one (default: the current year)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report the rows that would be moved",
+        )
+
+    def handle(self, *args, **options):
+        current_year = timezone.localdate().year
+        before = options["before"] or current_year
+        if before > current_year:
+            raise CommandError("Only closed years can be archived.")
+
+        started = time.perf_counter()
+        plan = (plan_archive if options["dry_run"] else archive_years)(before)
+        if not plan.years:
+            self.stdout.write(self.style.SUCCESS("Nothing to archive."))
+            return
+
+        for sheet_name, rows in plan.rows.items():
+            for year in sorted(plan.years):
+                self.stdout.write(f"{sheet_name} {year}: {len(rows[year])} rows")
+        verb = "Would move" if options["dry_run"] else "Moved"
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{verb} {plan.moved} rows with {len(plan.requests)} sheet "
+                f"operations in one request ({time.perf_counter() - started:.2f}s)"
+            )
+        )
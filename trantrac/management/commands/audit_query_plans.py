@@ -0,0 +1,161 @@
+import re
+from urllib.parse import urlencode
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from trantrac.management.commands.static_transfer_report import default_host
+from trantrac.models import Account, Category, Subcategory, Transaction
+
+User = get_user_model()
+
+# "SCAN <table>" without an index, as reported by EXPLAIN QUERY PLAN
+FULL_SCAN_RE = re.compile(r"^SCAN (\w+)(?: AS \w+)?$")
+
+
+def pages():
+    """Read-only pages exercised by the audit, with realistic parameters"""
+    category = Category.objects.order_by("pk").first()
+    account = Account.objects.order_by("pk").first()
+    month = timezone.localdate().replace(day=1)
+    history = reverse("history")
+    yield reverse("index")
+    yield reverse("receipt")
+    yield history
+    if category:
+        yield f"{history}?{urlencode({'category': category.pk})}"
+        yield f"{reverse('load_subcategories')}?category={category.pk}"
+    if account:
+        yield f"{history}?{urlencode({'account': account.pk})}"
+    if last := Transaction.objects.order_by("-date", "-id").first():
+        yield f"{history}?{urlencode({'after': f'{last.date}_{last.pk}'})}"
+    yield f"{reverse('search')}?q=spesa"
+    yield reverse("dashboard")
+    yield f"{reverse('dashboard')}?month={month:%Y-%m}"
+    yield f"{reverse('predict_category')}?description=supermercato"
+    yield reverse("category_map")
+    yield f"{reverse('export_transactions')}?format=csv"
+
+
+def lookups():
+    """Lookups done outside of GET requests (sheet refresh, imports, forms)"""
+    category = Category(pk=1, name="Spesa")
+    return {
+        "Category by name": Category.objects.filter(name="Spesa"),
+        "Categories by names": Category.objects.filter(name__in=["Spesa", "Casa"]),
+        "Subcategory by category and name": Subcategory.objects.filter(
+            category=category, name="Supermercato"
+        ),
+        "Account by name": Account.objects.filter(name="Comune"),
+        "Transactions by external id": Transaction.objects.filter(
+            external_id__in=["a", "b"]
+        ),
+        "Transactions by client id": Transaction.objects.filter(
+            client_id__in=["6f1c1a4e-8f4a-4d1e-9a55-3c6c1c1f0a01"]
+        ),
+    }
+
+
+class Command(BaseCommand):
+    help = (
+        "Load the app's pages, run EXPLAIN QUERY PLAN on every query they issue "
+        "and fail if any scans a large table without an index"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            action="append",
+            help="Page to load, can be repeated (default: the app's main pages)",
+        )
+        parser.add_argument(
+            "--email",
+            help="Load the pages as this user (default: the first superuser)",
+        )
+        parser.add_argument(
+            "--host",
+            default=default_host(),
+            help="Host header to send (default: first entry of ALLOWED_HOSTS)",
+        )
+        parser.add_argument(
+            "--min-rows",
+            type=int,
+            default=1000,
+            help="Tables with at least this many rows count as large (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        if options["email"]:
+            user = User.objects.filter(email=options["email"]).first()
+        else:
+            user = User.objects.filter(is_superuser=True).order_by("pk").first()
+        if user is None:
+            raise CommandError("No user to load the pages with")
+        client = Client(HTTP_HOST=options["host"])
+        client.force_login(user)
+
+        self.sizes = {}
+        self.min_rows = options["min_rows"]
+        failures = 0
+        for path in options["path"] or pages():
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(path)
+                if response.streaming:
+                    # Streaming responses run their queries while consumed
+                    for _ in response.streaming_content:
+                        pass
+                    response.close()
+            scans = [
+                (table, query["sql"])
+                for query in queries.captured_queries
+                for table in self.full_scans(query["sql"])
+            ]
+            failures += len(scans)
+            style = self.style.ERROR if scans else self.style.SUCCESS
+            self.stdout.write(
+                style(f"{path}: {response.status_code}, {len(queries)} queries")
+            )
+            for table, sql in scans:
+                self.stdout.write(self.style.ERROR(f"  full scan of {table}: {sql}"))
+
+        for name, queryset in lookups().items():
+            sql, params = queryset.query.sql_with_params()
+            scans = self.full_scans(sql, params, always=True)
+            failures += len(scans)
+            if scans:
+                self.stdout.write(
+                    self.style.ERROR(f"{name}: full scan of {', '.join(scans)}")
+                )
+            else:
+                self.stdout.write(self.style.SUCCESS(f"{name}: indexed"))
+
+        if failures:
+            raise CommandError(f"{failures} full table scans found")
+
+    def full_scans(self, sql, params=(), always=False):
+        """Tables a query reads in full, if large (or whatever their size)"""
+        if not sql.lstrip().upper().startswith(("SELECT", "WITH")):
+            return []
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            plan = cursor.fetchall()
+        tables = []
+        for *_, detail in plan:
+            match = FULL_SCAN_RE.match(detail)
+            if match and (always or self.table_size(match[1]) >= self.min_rows):
+                tables.append(match[1])
+        return tables
+
+    def table_size(self, table):
+        if table not in self.sizes:
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"SELECT COUNT(*) FROM {connection.ops.quote_name(table)}"  # nosec B608
+                )
+                self.sizes[table] = cursor.fetchone()[0]
+        return self.sizes[table]
@@ -0,0 +1,128 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db import transaction as db_transaction
+from django.db.models import F
+from django.utils import timezone
+
+from trantrac.cache import QUICK_PICKS, invalidate
+from trantrac.models import CategoryUsage
+
+# PRAGMA auto_vacuum value for INCREMENTAL
+INCREMENTAL = 2
+
+
+class Command(BaseCommand):
+    help = (
+        "Fold the category uses older than the retention window into one row "
+        "per user, category, subcategory and month, then give the freed pages "
+        "back to the filesystem"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=settings.CATEGORY_USAGE_RETENTION_DAYS,
+            help="Keep the uses of the last N days as they are "
+            f"(default: {settings.CATEGORY_USAGE_RETENTION_DAYS})",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=1000,
+            help="Maximum number of rows deleted per transaction (default: 1000)",
+        )
+        parser.add_argument(
+            "--vacuum",
+            action="store_true",
+            help="Run a full VACUUM first if the database isn't in incremental "
+            "auto-vacuum mode yet (locks the database while it runs)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only count the rows that would be folded",
+        )
+
+    def handle(self, *args, **options):
+        if options["days"] < 0 or options["batch_size"] < 1:
+            raise CommandError("--days must be >= 0 and --batch-size >= 1")
+        cutoff = timezone.now() - timedelta(days=options["days"])
+
+        # The latest row of each month is kept and takes the count of the
+        # others: the most used picks sum the counts and the recent ones look
+        # at the latest use, so both stay the same
+        survivors = {}
+        folded = []
+        rows = (
+            CategoryUsage.objects.filter(created_at__lt=cutoff)
+            .order_by("-id")
+            .values_list("id", "user", "category", "subcategory", "created_at", "count")
+        )
+        for pk, user, category, subcategory, created_at, count in rows.iterator(
+            chunk_size=2000
+        ):
+            month = timezone.localtime(created_at).strftime("%Y-%m")
+            key = (user, category, subcategory, month)
+            if key in survivors:
+                folded.append((pk, survivors[key], count))
+            else:
+                survivors[key] = pk
+
+        self.stdout.write(
+            f"{len(folded)} uses to fold into {len(survivors)} monthly rows"
+        )
+        if options["dry_run"]:
+            return
+
+        # Oldest first: an interrupted run leaves whole batches folded, each
+        # one deleted together with the update of its survivors
+        folded.reverse()
+        size = options["batch_size"]
+        for start in range(0, len(folded), size):
+            batch = folded[start : start + size]
+            totals = {}
+            for _, survivor, count in batch:
+                totals[survivor] = totals.get(survivor, 0) + count
+            with db_transaction.atomic():
+                CategoryUsage.objects.filter(pk__in=[pk for pk, _, _ in batch]).delete()
+                for survivor, count in totals.items():
+                    CategoryUsage.objects.filter(pk=survivor).update(
+                        count=F("count") + count
+                    )
+        if folded:
+            # Bulk deletes and updates don't send the signals that do this
+            invalidate(QUICK_PICKS)
+
+        self.reclaim(options["vacuum"])
+        self.stdout.write(self.style.SUCCESS(f"Summary: {len(folded)} uses folded"))
+
+    def reclaim(self, vacuum):
+        """Release the free pages, a bounded number per write transaction"""
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA auto_vacuum")
+            if cursor.fetchone()[0] != INCREMENTAL:
+                if not vacuum:
+                    self.stdout.write(
+                        self.style.WARNING(
+                            "The database isn't in incremental auto-vacuum mode: "
+                            "run once with --vacuum to switch it"
+                        )
+                    )
+                    return
+                self.stdout.write("Running VACUUM to switch to incremental auto-vacuum")
+                cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                cursor.execute("VACUUM")
+            cursor.execute("PRAGMA freelist_count")
+            free = cursor.fetchone()[0]
+            released = 0
+            while free:
+                # incremental_vacuum only releases pages once fully stepped
+                cursor.execute("PRAGMA incremental_vacuum(1000)").fetchall()
+                cursor.execute("PRAGMA freelist_count")
+                free, released = cursor.fetchone()[0], released + min(free, 1000)
+            cursor.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        self.stdout.write(f"{released} free pages released")
@@ -0,0 +1,64 @@
+import datetime
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from trantrac.models import Account, Category, Transaction
+from trantrac.utils import (
+    export_csv,
+    export_parquet,
+    filter_transactions,
+    parquet_available,
+)
+
+
+class Command(BaseCommand):
+    help = "Export the recorded transactions to CSV or Parquet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "output",
+            nargs="?",
+            default="-",
+            help="Output file, '-' for standard output (default, CSV only)",
+        )
+        parser.add_argument(
+            "--format", choices=["csv", "parquet"], default="csv", help="Output format"
+        )
+        parser.add_argument(
+            "--date-from", type=datetime.date.fromisoformat, help="YYYY-MM-DD"
+        )
+        parser.add_argument(
+            "--date-to", type=datetime.date.fromisoformat, help="YYYY-MM-DD"
+        )
+        parser.add_argument("--account", help="Account name")
+        parser.add_argument("--category", help="Category name")
+
+    def handle(self, *args, **options):
+        filters = {
+            "date_from": options["date_from"],
+            "date_to": options["date_to"],
+        }
+        for name, model in (("account", Account), ("category", Category)):
+            if options[name]:
+                filters[name] = model.objects.filter(name=options[name]).first()
+                if filters[name] is None:
+                    raise CommandError(f"Unknown {name}: {options[name]}")
+        transactions = filter_transactions(Transaction.objects.all(), **filters)
+
+        output = options["output"]
+        if options["format"] == "parquet":
+            if not parquet_available():
+                raise CommandError("Parquet export requires pyarrow")
+            if output == "-":
+                raise CommandError("Parquet can't be written to standard output")
+            export_parquet(transactions, output)
+        elif output == "-":
+            for chunk in export_csv(transactions):
+                sys.stdout.write(chunk)
+        else:
+            with open(output, "w", newline="", encoding="utf-8") as file:
+                file.writelines(export_csv(transactions))
+
+        if output != "-":
+            self.stdout.write(self.style.SUCCESS(f"Transactions exported to {output}"))
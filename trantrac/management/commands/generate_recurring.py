@@ -0,0 +1,97 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+from django.db import transaction as db_transaction
+from django.utils import timezone
+
+from trantrac.cache import QUICK_PICKS, invalidate
+from trantrac.models import CategoryUsage, RecurringTransaction, Transaction
+from trantrac.utils import record_transactions
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the occurrences of the recurring transactions due since the last "
+        "run, with one bulk insert and one append per sheet"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--until",
+            type=date.fromisoformat,
+            help="Generate the occurrences up to this date, YYYY-MM-DD (default: today)",
+        )
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only list the occurrences that would be written",
+        )
+
+    def handle(self, *args, **options):
+        until = options["until"] or timezone.localdate()
+        templates = list(
+            RecurringTransaction.objects.filter(active=True, start_date__lte=until)
+            .exclude(last_date__gte=until)
+            .select_related("user", "category", "subcategory", "account")
+        )
+        due = []
+        for template in templates:
+            try:
+                due += [
+                    (template, template.build(day)) for day in template.due_dates(until)
+                ]
+            except ValueError as e:
+                # Saved before the interval was validated: report it, run the rest
+                self.stderr.write(self.style.ERROR(f"Skipped: {e}"))
+        # Occurrences written by a run interrupted before saving its progress
+        recorded = set(
+            Transaction.objects.filter(
+                client_id__in=[transaction.client_id for _, transaction in due]
+            ).values_list("client_id", flat=True)
+        )
+        new = [
+            (template, transaction)
+            for template, transaction in due
+            if transaction.client_id not in recorded
+        ]
+
+        if not due:
+            self.stdout.write(self.style.SUCCESS("Nothing due."))
+            return
+        for template, transaction in new:
+            self.stdout.write(
+                f"{transaction.date} {transaction.amount:.2f} {template.description}"
+            )
+        if options["dry_run"]:
+            return
+
+        synced = True
+        if new:
+            synced = record_transactions([transaction for _, transaction in new])
+        with db_transaction.atomic():
+            # bulk_create skips the post_save signal that refreshes the quick picks
+            CategoryUsage.objects.bulk_create(
+                CategoryUsage(
+                    user=template.user,
+                    category=template.category,
+                    subcategory=template.subcategory,
+                )
+                for template, _ in new
+            )
+            for template, transaction in due:
+                template.last_date = max(
+                    template.last_date or transaction.date, transaction.date
+                )
+            RecurringTransaction.objects.bulk_update(
+                {template for template, _ in due}, ["last_date"]
+            )
+        if new:
+            invalidate(QUICK_PICKS)
+
+        style = self.style.SUCCESS if synced else self.style.ERROR
+        self.stdout.write(
+            style(
+                f"Summary: {len(new)} transactions written"
+                + ("" if synced else ", not yet synced with the sheet")
+            )
+        )
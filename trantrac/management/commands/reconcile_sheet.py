@@ -0,0 +1,124 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from trantrac.reconcile import (
+    SHEET_KINDS,
+    reconcile_categories,
+    reconcile_sheet,
+    repair_categories,
+    repair_sheet,
+)
+
+SHEETS = [*SHEET_KINDS, "CATEGORIE"]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the spreadsheet with the transactions and categories recorded "
+        "locally, reporting (and optionally repairing) missing or duplicated rows"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sheet",
+            action="append",
+            choices=SHEETS,
+            help="Sheet to check, can be repeated (default: all)",
+        )
+        parser.add_argument(
+            "--repair",
+            action="store_true",
+            help="Re-append missing rows and delete duplicated ones",
+        )
+        parser.add_argument(
+            "--locate",
+            action="store_true",
+            help=(
+                "Find the rows of transactions synced before their position was "
+                "recorded (reads the whole sheet once)"
+            ),
+        )
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        drift = False
+        for sheet_name in options["sheet"] or SHEETS:
+            if sheet_name == "CATEGORIE":
+                report = reconcile_categories()
+                self.write_categories(report)
+            else:
+                report = reconcile_sheet(sheet_name, locate=options["locate"])
+                self.write_sheet(report)
+
+            if report.in_sync:
+                continue
+            drift = True
+            if not options["repair"]:
+                continue
+            repaired = (
+                repair_categories(report)
+                if sheet_name == "CATEGORIE"
+                else repair_sheet(report)
+            )
+            if repaired:
+                self.stdout.write(self.style.SUCCESS(f"{sheet_name}: repaired"))
+            else:
+                self.stdout.write(
+                    self.style.ERROR(
+                        f"{sheet_name}: too many missing rows, not repairing. "
+                        "Check the sheet's locale and formats first."
+                    )
+                )
+
+        style = self.style.WARNING if drift else self.style.SUCCESS
+        self.stdout.write(
+            style(
+                f"\n{'Drift found' if drift else 'Sheets in sync'} "
+                f"({time.perf_counter() - started:.2f}s)"
+            )
+        )
+
+    def write_sheet(self, report):
+        self.stdout.write(
+            f"{report.sheet_name}: {report.checked} recorded rows, "
+            f"{report.dirty_blocks}/{report.blocks} blocks differ, "
+            f"{report.rows_read} rows read, {report.foreign} rows not from the app"
+        )
+        for transaction in report.missing:
+            self.stdout.write(
+                self.style.ERROR(
+                    f"  missing: {transaction.date} {transaction.amount} "
+                    f"{transaction.description} (#{transaction.pk})"
+                )
+            )
+        for row in report.duplicates:
+            self.stdout.write(self.style.ERROR(f"  duplicate: row {row}"))
+        if report.relocated:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"  {len(report.relocated)} rows moved (rows inserted or "
+                    "deleted by hand above them)"
+                )
+            )
+        if report.located:
+            self.stdout.write(f"  located {len(report.located)} unplaced rows")
+        elif report.unplaced:
+            self.stdout.write(
+                self.style.WARNING(
+                    f"  {report.unplaced} synced rows have no recorded position, "
+                    "run with --locate to check them"
+                )
+            )
+
+    def write_categories(self, report):
+        self.stdout.write(
+            f"CATEGORIE: {report.checked} local subcategories, "
+            f"{len(report.only_in_sheet)} only in the sheet"
+        )
+        for category, subcategory in report.missing:
+            self.stdout.write(
+                self.style.ERROR(f"  missing: {category} / {subcategory}")
+            )
+        for row in report.duplicates:
+            self.stdout.write(self.style.ERROR(f"  duplicate: row {row}"))
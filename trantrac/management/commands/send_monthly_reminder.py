@@ -1,86 +1,193 @@
 import os
+import smtplib
+import time
+from datetime import timedelta
 
+from anymail.exceptions import AnymailError
 from django.conf import settings
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
 from django.core.management.base import BaseCommand
+from django.db.models import Q, Sum
 from django.urls import reverse
+from django.utils import timezone
+
+from trantrac.models import MonthlySpending
+from trantrac.utils import format_cents
 
 User = get_user_model()
 
+SIGNATURE = "Grazie,\nTranTrac"
+
 
 class Command(BaseCommand):
     help = "Send monthly reminder to admin users to import bank transactions"
 
-    def handle(self, *args, **options):
-        # Get all admin/staff users
-        admin_users = User.objects.filter(is_staff=True) | User.objects.filter(
-            is_superuser=True
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Build the emails and list the recipients without sending anything",
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=50,
+            help="Maximum number of emails sent over a single connection (default: 50)",
         )
-        admin_users = admin_users.distinct()
-
-        if not admin_users.exists():
-            self.stdout.write(
-                self.style.WARNING("No admin users found. Email not sent.")
-            )
-            return
-
-        # Prepare email content
-        subject = "Reminder: Import transazioni bancarie"
 
+    def build_message(self):
         # Build upload URL if SITE_URL is configured
         upload_path = reverse("upload_csv")
         site_url = os.getenv("SITE_URL", "").rstrip("/")
 
         if site_url:
             upload_url = f"{site_url}{upload_path}"
-            message = f"""
+            return f"""
 Ciao,
 
 Questo è un promemoria mensile per ricordarti di importare le transazioni bancarie.
 
 Accedi alla pagina di upload CSV per aggiungere le nuove transazioni del mese:
 {upload_url}
-
-Grazie,
-TranTrac
             """.strip()
-        else:
-            message = """
+
+        return """
 Ciao,
 
 Questo è un promemoria mensile per ricordarti di importare le transazioni bancarie.
 
 Accedi all'applicazione e vai alla pagina di upload CSV per aggiungere le nuove transazioni del mese.
-
-Grazie,
-TranTrac
             """.strip()
 
-        # Send email to each admin user
+    def get_spending_summaries(self, user_ids, month):
+        """Build the per-user spending summary for `month` from the rollup table"""
+        rows = (
+            MonthlySpending.objects.filter(user_id__in=user_ids, month=month)
+            .values_list("user_id", "category__name")
+            .annotate(total=Sum("total_cents"))
+            .order_by("user_id", "-total")
+        )
+
+        lines_by_user = {}
+        totals_by_user = {}
+        for user_id, category_name, total_cents in rows:
+            lines_by_user.setdefault(user_id, []).append(
+                f"- {category_name}: € {format_cents(total_cents)}"
+            )
+            totals_by_user[user_id] = totals_by_user.get(user_id, 0) + total_cents
+
+        return {
+            user_id: "\n".join(
+                [
+                    f"Le tue spese registrate a {month:%m/%Y}:",
+                    *lines,
+                    f"Totale: € {format_cents(totals_by_user[user_id])}",
+                ]
+            )
+            for user_id, lines in lines_by_user.items()
+        }
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        dry_run = options["dry_run"]
+        batch_size = max(options["batch_size"], 1)
+
+        # Get all admin/staff users
+        recipients = list(
+            User.objects.filter(Q(is_staff=True) | Q(is_superuser=True))
+            .order_by("pk")
+            .values_list("pk", "email")
+        )
+
+        if not recipients:
+            self.stdout.write(
+                self.style.WARNING("No admin users found. Email not sent.")
+            )
+            return
+
+        # Prepare the shared email content once, then add each user's summary
+        subject = "Reminder: Import transazioni bancarie"
+        message = self.build_message()
+        last_month = (timezone.localdate().replace(day=1) - timedelta(days=1)).replace(
+            day=1
+        )
+        summaries = self.get_spending_summaries(
+            [pk for pk, _ in recipients], last_month
+        )
+        emails = [
+            EmailMessage(
+                subject=subject,
+                body="\n\n".join(
+                    part for part in (message, summaries.get(pk), SIGNATURE) if part
+                ),
+                from_email=settings.DEFAULT_FROM_EMAIL,
+                to=[email],
+            )
+            for pk, email in recipients
+        ]
+
+        if dry_run:
+            for email in emails:
+                self.stdout.write(f"[dry-run] Email to {email.to[0]}")
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f"\nSummary: {len(emails)} emails prepared, none sent "
+                    f"({time.perf_counter() - started:.2f}s)"
+                )
+            )
+            return
+
+        # Send in batches, reusing one connection per batch
         sent_count = 0
         failed_count = 0
 
-        for user in admin_users:
+        for start in range(0, len(emails), batch_size):
+            batch = emails[start : start + batch_size]
+            batch_started = time.perf_counter()
+            connection = get_connection(fail_silently=False)
             try:
-                send_mail(
-                    subject=subject,
-                    message=message,
-                    from_email=settings.DEFAULT_FROM_EMAIL,
-                    recipient_list=[user.email],
-                    fail_silently=False,
-                )
-                sent_count += 1
-                self.stdout.write(self.style.SUCCESS(f"Email sent to {user.email}"))
-            except Exception as e:
-                failed_count += 1
-                self.stdout.write(
-                    self.style.ERROR(f"Failed to send email to {user.email}: {str(e)}")
-                )
+                connection.open()
+            except (smtplib.SMTPException, OSError, AnymailError) as e:
+                # Nothing of this batch went out
+                failed_count += len(batch)
+                for email in batch:
+                    self.stdout.write(
+                        self.style.ERROR(f"Failed to send email to {email.to[0]}: {e}")
+                    )
+                continue
+
+            # One message at a time over the shared connection, so a failure
+            # only affects its own recipient
+            try:
+                for email in batch:
+                    try:
+                        connection.send_messages([email])
+                    except (smtplib.SMTPException, OSError, AnymailError) as e:
+                        failed_count += 1
+                        self.stdout.write(
+                            self.style.ERROR(
+                                f"Failed to send email to {email.to[0]}: {e}"
+                            )
+                        )
+                        # The next message opens a new connection
+                        connection.close()
+                    else:
+                        sent_count += 1
+                        self.stdout.write(
+                            self.style.SUCCESS(f"Email sent to {email.to[0]}")
+                        )
+            finally:
+                connection.close()
+            self.stdout.write(
+                f"Batch of {len(batch)} sent in "
+                f"{time.perf_counter() - batch_started:.2f}s"
+            )
 
         # Summary
         self.stdout.write(
             self.style.SUCCESS(
-                f"\nSummary: {sent_count} emails sent, {failed_count} failed"
+                f"\nSummary: {sent_count} emails sent, {failed_count} failed "
+                f"({time.perf_counter() - started:.2f}s)"
             )
         )
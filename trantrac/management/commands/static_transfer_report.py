@@ -0,0 +1,133 @@
+import re
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.urls import reverse
+
+User = get_user_model()
+
+STATIC_ASSET_RE = re.compile(r'(?:src|href)="({}[^"]+)"')
+
+
+def default_host():
+    """First concrete host in ALLOWED_HOSTS, tolerating the `[a, b]` env format"""
+    for host in settings.ALLOWED_HOSTS:
+        host = host.strip("[] ").lstrip(".")
+        if host and host != "*":
+            return host
+    return "localhost"
+
+
+def body_size(response):
+    if response.streaming:
+        size = sum(len(chunk) for chunk in response.streaming_content)
+        response.close()
+        return size
+    return len(response.content)
+
+
+class Command(BaseCommand):
+    help = "Report bytes transferred for a cold and a warm load of a page and its static assets"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--path",
+            help="Page to load (default: the index page, or the login page if no --email)",
+        )
+        parser.add_argument(
+            "--email",
+            help="Load the page logged in as this user instead of anonymously",
+        )
+        parser.add_argument(
+            "--host",
+            default=default_host(),
+            help="Host header to send (default: first entry of ALLOWED_HOSTS)",
+        )
+
+    def handle(self, *args, **options):
+        client = Client(HTTP_HOST=options["host"], HTTP_ACCEPT_ENCODING="br, gzip")
+        path = options["path"]
+        if options["email"]:
+            try:
+                client.force_login(User.objects.get(email=options["email"]))
+            except User.DoesNotExist as e:
+                raise CommandError(f"No user with email {options['email']}") from e
+            path = path or reverse("index")
+        path = path or reverse("account_login")
+
+        page = client.get(path)
+        if page.status_code != 200:
+            raise CommandError(f"{path} returned {page.status_code}")
+        html = page.content.decode()
+        pattern = re.compile(
+            STATIC_ASSET_RE.pattern.format(re.escape(settings.STATIC_URL))
+        )
+        assets = list(dict.fromkeys(pattern.findall(html)))
+
+        rows = []
+        for url in assets:
+            cold = client.get(url)
+            cold_size = body_size(cold)
+            cache_control = cold.headers.get("Cache-Control", "")
+            if "immutable" in cache_control:
+                # The browser won't even ask for it again
+                warm_size, warm_status = 0, "cached"
+            else:
+                validators = {}
+                if etag := cold.headers.get("ETag"):
+                    validators["HTTP_IF_NONE_MATCH"] = etag
+                if last_modified := cold.headers.get("Last-Modified"):
+                    validators["HTTP_IF_MODIFIED_SINCE"] = last_modified
+                warm = client.get(url, **validators)
+                warm_size, warm_status = body_size(warm), str(warm.status_code)
+            rows.append(
+                (
+                    url,
+                    cold.status_code,
+                    cold.headers.get("Content-Encoding", "identity"),
+                    cold_size,
+                    warm_status,
+                    warm_size,
+                    cache_control,
+                )
+            )
+
+        page_size = len(page.content)
+        self.stdout.write(
+            f"{'asset':60} {'enc':8} {'cold':>9} {'warm':>9}  cache-control"
+        )
+        self.stdout.write(f"{path:60} {'identity':8} {page_size:>9} {page_size:>9}")
+        for (
+            url,
+            status,
+            encoding,
+            cold_size,
+            warm_status,
+            warm_size,
+            cache_control,
+        ) in rows:
+            if status != 200:
+                self.stdout.write(self.style.ERROR(f"{url:60} HTTP {status}"))
+                continue
+            self.stdout.write(
+                f"{url:60} {encoding:8} {cold_size:>9} {warm_size:>9}  "
+                f"{cache_control} ({warm_status})"
+            )
+
+        cold_total = page_size + sum(row[3] for row in rows)
+        warm_total = page_size + sum(row[5] for row in rows)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"\nCold load: {cold_total} bytes, warm load: {warm_total} bytes "
+                f"({len(assets)} static assets)"
+            )
+        )
+        if not all("immutable" in row[6] for row in rows):
+            self.stdout.write(
+                self.style.WARNING(
+                    "Some assets are not served as immutable: run collectstatic "
+                    "and load the page with DEBUG off to use the hashed files."
+                )
+            )
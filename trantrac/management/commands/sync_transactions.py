@@ -0,0 +1,58 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from trantrac.models import Transaction
+from trantrac.utils import sync_transactions
+
+# Pending rows younger than this may still be being appended by the request
+# that created them
+PENDING_GRACE_PERIOD = timedelta(minutes=5)
+
+
+class Command(BaseCommand):
+    help = (
+        "Replicate to Google Sheets the transactions whose sync failed, and the "
+        "ones still pending after 5 minutes (younger ones may be in the middle "
+        "of the request that is appending them)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Maximum number of rows appended per Sheets request (default: 500)",
+        )
+
+    def handle(self, *args, **options):
+        batch_size = max(options["batch_size"], 1)
+        pending = list(
+            Transaction.objects.filter(
+                Q(sync_state=Transaction.SyncState.FAILED)
+                | Q(
+                    sync_state=Transaction.SyncState.PENDING,
+                    created_at__lt=timezone.now() - PENDING_GRACE_PERIOD,
+                )
+            )
+            .select_related("category", "subcategory", "account")
+            .order_by("date", "id")
+        )
+
+        if not pending:
+            self.stdout.write(self.style.SUCCESS("Nothing to sync."))
+            return
+
+        failed = 0
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start : start + batch_size]
+            if not sync_transactions(batch):
+                failed += len(batch)
+
+        synced = len(pending) - failed
+        style = self.style.SUCCESS if not failed else self.style.ERROR
+        self.stdout.write(
+            style(f"Summary: {synced} transactions synced, {failed} failed")
+        )
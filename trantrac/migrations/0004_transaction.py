@@ -0,0 +1,122 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:25
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0003_monthlyspending"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Transaction",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "kind",
+                    models.CharField(
+                        choices=[("U", "uscita"), ("E", "entrata")],
+                        default="U",
+                        max_length=1,
+                    ),
+                ),
+                ("date", models.DateField()),
+                ("amount_cents", models.PositiveIntegerField()),
+                ("description", models.TextField(blank=True)),
+                ("payer", models.CharField(blank=True, max_length=50)),
+                ("bank_category", models.CharField(blank=True, max_length=100)),
+                ("external_id", models.CharField(blank=True, max_length=100)),
+                (
+                    "sync_state",
+                    models.PositiveSmallIntegerField(
+                        choices=[
+                            (0, "da sincronizzare"),
+                            (1, "sincronizzata"),
+                            (2, "sincronizzazione fallita"),
+                        ],
+                        default=0,
+                    ),
+                ),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "account",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="trantrac.account",
+                    ),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="trantrac.category",
+                    ),
+                ),
+                (
+                    "subcategory",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="trantrac.subcategory",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "transazione",
+                "verbose_name_plural": "transazioni",
+                "ordering": ["-date", "-id"],
+                "indexes": [
+                    models.Index(
+                        fields=["-date", "-id"], name="trantrac_tr_date_062172_idx"
+                    ),
+                    models.Index(
+                        fields=["user", "date"], name="trantrac_tr_user_id_ecf83c_idx"
+                    ),
+                    models.Index(
+                        fields=["category", "date"],
+                        name="trantrac_tr_categor_cefa54_idx",
+                    ),
+                    models.Index(
+                        fields=["account", "date"],
+                        name="trantrac_tr_account_07c189_idx",
+                    ),
+                    models.Index(
+                        condition=models.Q(("sync_state", 1), _negated=True),
+                        fields=["sync_state"],
+                        name="trantrac_tr_unsynced_idx",
+                    ),
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        condition=models.Q(("external_id", ""), _negated=True),
+                        fields=("external_id",),
+                        name="unique_transaction_external_id",
+                    )
+                ],
+            },
+        ),
+    ]
@@ -0,0 +1,50 @@
+from django.db import migrations
+
+CREATE_FTS = """
+CREATE VIRTUAL TABLE trantrac_transaction_fts USING fts5(
+    description,
+    content='trantrac_transaction',
+    content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+
+CREATE TRIGGER trantrac_transaction_fts_insert AFTER INSERT ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(rowid, description)
+    VALUES (new.id, new.description);
+END;
+
+CREATE TRIGGER trantrac_transaction_fts_delete AFTER DELETE ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts, rowid, description)
+    VALUES ('delete', old.id, old.description);
+END;
+
+CREATE TRIGGER trantrac_transaction_fts_update
+AFTER UPDATE OF description ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts, rowid, description)
+    VALUES ('delete', old.id, old.description);
+    INSERT INTO trantrac_transaction_fts(rowid, description)
+    VALUES (new.id, new.description);
+END;
+
+INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts) VALUES ('rebuild');
+"""
+
+DROP_FTS = """
+DROP TRIGGER IF EXISTS trantrac_transaction_fts_update;
+DROP TRIGGER IF EXISTS trantrac_transaction_fts_delete;
+DROP TRIGGER IF EXISTS trantrac_transaction_fts_insert;
+DROP TABLE IF EXISTS trantrac_transaction_fts;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0004_transaction"),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_FTS, DROP_FTS),
+    ]
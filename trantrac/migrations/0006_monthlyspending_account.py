@@ -0,0 +1,46 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:38
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0005_transaction_fts"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name="monthlyspending",
+            name="unique_monthly_spending",
+        ),
+        migrations.AddField(
+            model_name="monthlyspending",
+            name="account",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.SET_NULL,
+                to="trantrac.account",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="monthlyspending",
+            index=models.Index(fields=["month"], name="trantrac_mo_month_e6f6f7_idx"),
+        ),
+        migrations.AddConstraint(
+            model_name="monthlyspending",
+            constraint=models.UniqueConstraint(
+                models.F("user"),
+                models.F("month"),
+                models.F("category"),
+                django.db.models.functions.comparison.Coalesce(
+                    "account", 0, output_field=models.IntegerField()
+                ),
+                name="unique_monthly_spending",
+            ),
+        ),
+    ]
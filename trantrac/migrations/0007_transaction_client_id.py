@@ -0,0 +1,38 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:43
+
+from django.db import migrations, models
+
+# A unique AddField makes SQLite's schema editor rebuild the table, which
+# drops the full-text search triggers of 0005: the column and its unique
+# index are added in place instead
+ADD_CLIENT_ID = """
+ALTER TABLE trantrac_transaction ADD COLUMN client_id char(32) NULL;
+CREATE UNIQUE INDEX trantrac_transaction_client_id_uniq
+    ON trantrac_transaction (client_id);
+"""
+
+DROP_CLIENT_ID = """
+DROP INDEX IF EXISTS trantrac_transaction_client_id_uniq;
+ALTER TABLE trantrac_transaction DROP COLUMN client_id;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0006_monthlyspending_account"),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[migrations.RunSQL(ADD_CLIENT_ID, DROP_CLIENT_ID)],
+            state_operations=[
+                migrations.AddField(
+                    model_name="transaction",
+                    name="client_id",
+                    field=models.UUIDField(
+                        blank=True, editable=False, null=True, unique=True
+                    ),
+                ),
+            ],
+        ),
+    ]
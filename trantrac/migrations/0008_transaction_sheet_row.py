@@ -0,0 +1,17 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0007_transaction_client_id"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="transaction",
+            name="sheet_row",
+            field=models.PositiveIntegerField(blank=True, editable=False, null=True),
+        ),
+    ]
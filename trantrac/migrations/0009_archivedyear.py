@@ -0,0 +1,33 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0008_transaction_sheet_row"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ArchivedYear",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("year", models.PositiveSmallIntegerField(unique=True)),
+                ("archived_at", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "verbose_name": "anno archiviato",
+                "verbose_name_plural": "anni archiviati",
+                "ordering": ["year"],
+            },
+        ),
+    ]
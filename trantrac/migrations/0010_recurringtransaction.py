@@ -0,0 +1,94 @@
+# Generated by Django 6.1.2 on 2026-10-19 07:54
+
+import django.core.validators
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0009_archivedyear"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RecurringTransaction",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("description", models.CharField(max_length=200)),
+                ("amount_cents", models.PositiveIntegerField()),
+                (
+                    "frequency",
+                    models.CharField(
+                        choices=[
+                            ("W", "settimanale"),
+                            ("M", "mensile"),
+                            ("Y", "annuale"),
+                        ],
+                        default="M",
+                        max_length=1,
+                    ),
+                ),
+                (
+                    "interval",
+                    models.PositiveSmallIntegerField(
+                        default=1,
+                        help_text="Ogni quante settimane, mesi o anni",
+                        validators=[django.core.validators.MinValueValidator(1)],
+                    ),
+                ),
+                (
+                    "start_date",
+                    models.DateField(help_text="Data della prima occorrenza"),
+                ),
+                ("end_date", models.DateField(blank=True, null=True)),
+                ("active", models.BooleanField(default=True)),
+                ("last_date", models.DateField(blank=True, editable=False, null=True)),
+                (
+                    "account",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="trantrac.account",
+                    ),
+                ),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="trantrac.category",
+                    ),
+                ),
+                (
+                    "subcategory",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.PROTECT,
+                        to="trantrac.subcategory",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "transazione ricorrente",
+                "verbose_name_plural": "transazioni ricorrenti",
+                "ordering": ["description"],
+            },
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.1.2 on 2026-10-19 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0010_recurringtransaction"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="account",
+            index=models.Index(fields=["name"], name="trantrac_ac_name_d0f620_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="category",
+            index=models.Index(fields=["name"], name="trantrac_ca_name_8874ed_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="subcategory",
+            index=models.Index(
+                fields=["category", "name"], name="trantrac_su_categor_439a69_idx"
+            ),
+        ),
+    ]
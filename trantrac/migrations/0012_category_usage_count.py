@@ -0,0 +1,17 @@
+# Generated by Django 6.1.2 on 2026-10-19 08:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0011_lookup_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="categoryusage",
+            name="count",
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
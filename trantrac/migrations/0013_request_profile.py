@@ -0,0 +1,51 @@
+# Generated by Django 6.1.2 on 2026-10-19 08:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0012_category_usage_count"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RequestProfile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("method", models.CharField(max_length=10)),
+                ("path", models.CharField(max_length=500)),
+                ("status_code", models.PositiveSmallIntegerField()),
+                ("duration_ms", models.PositiveIntegerField()),
+                ("query_count", models.PositiveIntegerField()),
+                ("query_ms", models.PositiveIntegerField()),
+                ("profiler", models.CharField(max_length=20)),
+                ("report", models.TextField()),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                (
+                    "user",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "profilo richiesta",
+                "verbose_name_plural": "profili richieste",
+                "ordering": ["-id"],
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations
+
+# Databases migrated with the earlier 0007, which rebuilt trantrac_transaction
+# and dropped these triggers: recreate them and reindex what they missed
+RESTORE_TRIGGERS = """
+CREATE TRIGGER IF NOT EXISTS trantrac_transaction_fts_insert
+AFTER INSERT ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(rowid, description)
+    VALUES (new.id, new.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trantrac_transaction_fts_delete
+AFTER DELETE ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts, rowid, description)
+    VALUES ('delete', old.id, old.description);
+END;
+
+CREATE TRIGGER IF NOT EXISTS trantrac_transaction_fts_update
+AFTER UPDATE OF description ON trantrac_transaction
+BEGIN
+    INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts, rowid, description)
+    VALUES ('delete', old.id, old.description);
+    INSERT INTO trantrac_transaction_fts(rowid, description)
+    VALUES (new.id, new.description);
+END;
+
+INSERT INTO trantrac_transaction_fts(trantrac_transaction_fts) VALUES ('rebuild');
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("trantrac", "0013_request_profile"),
+    ]
+
+    operations = [
+        migrations.RunSQL(RESTORE_TRIGGERS, migrations.RunSQL.noop),
+    ]
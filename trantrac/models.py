@@ -1,33 +1,73 @@
+import calendar
+import threading
+import uuid
+from datetime import timedelta
+
 from django.conf import settings
-from django.db import models
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from django.core.exceptions import ValidationError
+from django.core.validators import MinValueValidator
+from django.db import connection, models
+from django.db import transaction as db_transaction
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from trantrac.cache import SPENDING, forget
+from trantrac.sheets import spreadsheet_values
 
 
 def save_category_and_sub_to_sheet(values):
-    credentials = service_account.Credentials.from_service_account_info(
-        settings.GOOGLE_SHEETS_CREDENTIALS, scopes=settings.SCOPES
-    )
-    service = build("sheets", "v4", credentials=credentials)
-
-    try:
-        body = {"values": values}
-        result = (
-            service.spreadsheets()
-            .values()
-            .append(
-                spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
-                range="CATEGORIE!A:B",
-                valueInputOption="USER_ENTERED",
-                insertDataOption="INSERT_ROWS",
-                body=body,
-            )
-            .execute()
+    body = {"values": values}
+    result = (
+        spreadsheet_values()
+        .append(
+            spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+            range="CATEGORIE!A:B",
+            valueInputOption="USER_ENTERED",
+            insertDataOption="INSERT_ROWS",
+            body=body,
         )
+        .execute()
+    )
+
+    return result.get("updates").get("updatedRows") == len(values)
+
 
-        return result.get("updates").get("updatedRows") == 1
-    finally:
-        service.close()
+# (category, subcategory) pairs waiting for the current transaction to commit
+_pending_pairs = threading.local()
+
+
+def queue_category_and_sub_for_sheet(category_name, name):
+    """Append a pair to CATEGORIE once the current transaction commits.
+
+    The pairs queued in the same transaction (e.g. an admin action on many
+    subcategories) go out together in a single append.
+    """
+    pending = getattr(_pending_pairs, "pairs", None)
+    if pending is None:
+        pending = _pending_pairs.pairs = []
+    pending.append((category_name, name))
+    # Registered on every call: the first callback to run sends the whole
+    # batch and the others find it empty. A callback dropped by a rollback
+    # can't leave the pairs stranded, and the rolled back ones are filtered
+    # out by send_queued_pairs.
+    db_transaction.on_commit(send_queued_pairs, robust=True)
+
+
+def send_queued_pairs():
+    pairs = set(getattr(_pending_pairs, "pairs", None) or ())
+    _pending_pairs.pairs = None
+    if not pairs:
+        return
+    saved = {
+        pair
+        for pair in Subcategory.objects.filter(
+            category__name__in={category for category, _ in pairs},
+            name__in={name for _, name in pairs},
+        ).values_list("category__name", "name")
+        if pair in pairs
+    }
+    if saved:
+        save_category_and_sub_to_sheet([list(pair) for pair in sorted(saved)])
 
 
 class Category(models.Model):
@@ -36,6 +76,7 @@ class Category(models.Model):
     class Meta:
         verbose_name = "categoria"
         verbose_name_plural = "categorie"
+        indexes = [models.Index(fields=["name"])]
 
     def __str__(self):
         return self.name
@@ -49,16 +90,30 @@ class Subcategory(models.Model):
     class Meta:
         verbose_name = "sottocategoria"
         verbose_name_plural = "sottocategorie"
+        indexes = [models.Index(fields=["category", "name"])]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # To tell an edit that renames the pair from one that doesn't
+        instance._loaded_pair = (
+            instance.__dict__.get("category_id"),
+            instance.__dict__.get("name"),
+        )
+        return instance
+
     def save(self, *args, **kwargs):
-        if not self.skip_sheet_save:
-            values = [[self.category.name, self.name]]
-            save_category_and_sub_to_sheet(values)
-            pass
+        pair = (self.category_id, self.name)
+        new_pair = self._state.adding or getattr(self, "_loaded_pair", pair) != pair
         super().save(*args, **kwargs)
+        # Only new pairs go to the sheet: re-saving an unchanged subcategory
+        # used to append it again
+        if new_pair and not self.skip_sheet_save:
+            queue_category_and_sub_for_sheet(self.category.name, self.name)
+        self._loaded_pair = pair
 
 
 class Account(models.Model):
@@ -70,6 +125,7 @@ class Account(models.Model):
     class Meta:
         verbose_name = "conto bancario"
         verbose_name_plural = "conti bancari"
+        indexes = [models.Index(fields=["name"])]
 
 
 class CategoryUsage(models.Model):
@@ -77,6 +133,8 @@ class CategoryUsage(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     subcategory = models.ForeignKey(Subcategory, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
+    # Uses folded into this row by compact_category_usage (1 for a single use)
+    count = models.PositiveIntegerField(default=1)
 
     class Meta:
         verbose_name = "utilizzo categoria"
@@ -89,3 +147,372 @@ class CategoryUsage(models.Model):
 
     def __str__(self):
         return f"{self.user} - {self.category} - {self.subcategory}"
+
+
+class Transaction(models.Model):
+    """Local ledger of every transaction; the spreadsheet is a replica of it"""
+
+    class Kind(models.TextChoices):
+        EXPENSE = "U", "uscita"
+        INCOME = "E", "entrata"
+
+    class SyncState(models.IntegerChoices):
+        PENDING = 0, "da sincronizzare"
+        SYNCED = 1, "sincronizzata"
+        FAILED = 2, "sincronizzazione fallita"
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=1, choices=Kind, default=Kind.EXPENSE)
+    date = models.DateField()
+    amount_cents = models.PositiveIntegerField()
+    description = models.TextField(blank=True)
+    payer = models.CharField(max_length=50, blank=True)
+    category = models.ForeignKey(
+        Category, on_delete=models.PROTECT, null=True, blank=True
+    )
+    subcategory = models.ForeignKey(
+        Subcategory, on_delete=models.PROTECT, null=True, blank=True
+    )
+    account = models.ForeignKey(
+        Account, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    # Income rows are not categorised locally: keep the bank's label for the sheet
+    bank_category = models.CharField(max_length=100, blank=True)
+    external_id = models.CharField(max_length=100, blank=True)
+    # Row of the sheet the transaction was appended to, set on sync
+    sheet_row = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    # Idempotency key of queued offline entries and generated recurring ones
+    client_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
+    sync_state = models.PositiveSmallIntegerField(
+        choices=SyncState, default=SyncState.PENDING
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "transazione"
+        verbose_name_plural = "transazioni"
+        ordering = ["-date", "-id"]
+        indexes = [
+            models.Index(fields=["-date", "-id"]),
+            models.Index(fields=["user", "date"]),
+            models.Index(fields=["category", "date"]),
+            models.Index(fields=["account", "date"]),
+            models.Index(
+                fields=["sync_state"],
+                condition=~models.Q(sync_state=1),  # SyncState.SYNCED
+                name="trantrac_tr_unsynced_idx",
+            ),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["external_id"],
+                condition=~models.Q(external_id=""),
+                name="unique_transaction_external_id",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.date} - {self.description} - {self.amount}"
+
+    @property
+    def amount(self):
+        return self.amount_cents / 100
+
+    @property
+    def sheet_name(self):
+        return "USCITE" if self.kind == self.Kind.EXPENSE else "ENTRATE"
+
+    def target_sheet(self, archived_years):
+        """Tab the transaction is written to: its year's tab once it's archived"""
+        if self.date.year in archived_years:
+            return f"{self.sheet_name} {self.date.year}"
+        return self.sheet_name
+
+    def to_sheet_row(self):
+        """Return the row written to the spreadsheet for this transaction"""
+        amount = f"{self.amount_cents / 100:.2f}".replace(".", ",")
+        description = self.description
+        # Bank imports have always been written with a shortened description
+        if self.external_id and len(description) > 50:
+            description = description[:47] + "..."
+
+        if self.kind == self.Kind.INCOME:
+            return [
+                self.payer,
+                self.date.strftime("%Y-%m-%d"),
+                amount,
+                description,
+                self.bank_category,
+                self.external_id,
+            ]
+        return [
+            self.payer,
+            self.date.strftime("%Y-%m-%d"),
+            amount,
+            description,
+            self.category.name if self.category else "",
+            self.subcategory.name if self.subcategory else "",
+            self.account.name if self.account else "",
+            self.external_id,
+        ]
+
+
+class MonthlySpending(models.Model):
+    """Per-user monthly spending by category, updated on every saved expense"""
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    month = models.DateField()  # first day of the month
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    # Like Transaction.account; see detach_account for the rows it would merge
+    account = models.ForeignKey(
+        Account, on_delete=models.SET_NULL, null=True, blank=True
+    )
+    total_cents = models.BigIntegerField(default=0)
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        verbose_name = "spesa mensile"
+        verbose_name_plural = "spese mensili"
+        indexes = [
+            models.Index(fields=["month"]),
+        ]
+        constraints = [
+            # COALESCE so rows without an account still conflict with each other
+            models.UniqueConstraint(
+                "user",
+                "month",
+                "category",
+                Coalesce("account", 0, output_field=models.IntegerField()),
+                name="unique_monthly_spending",
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user} - {self.month:%Y-%m} - {self.category}"
+
+    @classmethod
+    def record(cls, entries):
+        """Add (user_id, date, category_id, account_id, amount_cents) entries.
+
+        Entries are summed in memory first, then applied with one upsert per
+        (user, month, category, account) key so the totals are incremented in
+        place. Cached totals of the closed months touched are dropped once the
+        surrounding transaction commits.
+        """
+        totals = {}
+        for user_id, date, category_id, account_id, amount_cents in entries:
+            key = (user_id, date.replace(day=1), category_id, account_id)
+            total, count = totals.get(key, (0, 0))
+            totals[key] = (total + amount_cents, count + 1)
+
+        if not totals:
+            return
+
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"""
+                INSERT INTO {table}
+                    (user_id, month, category_id, account_id, total_cents, count)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (user_id, month, category_id, COALESCE(account_id, 0))
+                DO UPDATE SET
+                    total_cents = total_cents + excluded.total_cents,
+                    count = count + excluded.count
+                """,  # nosec B608
+                [
+                    (user_id, month, category_id, account_id, total, count)
+                    for (user_id, month, category_id, account_id), (
+                        total,
+                        count,
+                    ) in totals.items()
+                ],
+            )
+
+        current_month = timezone.localdate().replace(day=1)
+        closed_months = {
+            f"{month:%Y-%m}" for _, month, _, _ in totals if month < current_month
+        }
+        if closed_months:
+            db_transaction.on_commit(lambda: forget(SPENDING, *closed_months))
+
+    @classmethod
+    def detach_account(cls, account_id):
+        """Fold the totals of an account being deleted into the no-account rows.
+
+        Its transactions lose their account, so their totals belong with the
+        rows without one; setting account to NULL in place would instead break
+        the unique constraint wherever such a row already exists.
+        """
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {table}
+                    (user_id, month, category_id, account_id, total_cents, count)
+                SELECT user_id, month, category_id, NULL, total_cents, count
+                FROM {table}
+                WHERE account_id = %s
+                ON CONFLICT (user_id, month, category_id, COALESCE(account_id, 0))
+                DO UPDATE SET
+                    total_cents = total_cents + excluded.total_cents,
+                    count = count + excluded.count
+                """,  # nosec B608
+                [account_id],
+            )
+        cls.objects.filter(account_id=account_id).delete()
+
+
+class ArchivedYear(models.Model):
+    """A closed year whose rows were moved from the live tabs to its own tabs"""
+
+    year = models.PositiveSmallIntegerField(unique=True)
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "anno archiviato"
+        verbose_name_plural = "anni archiviati"
+        ordering = ["year"]
+
+    def __str__(self):
+        return str(self.year)
+
+    @classmethod
+    def years(cls):
+        return set(cls.objects.values_list("year", flat=True))
+
+
+def add_months(day, months):
+    """Same day `months` later, clamped to the end of shorter months"""
+    month = day.month - 1 + months
+    year, month = day.year + month // 12, month % 12 + 1
+    return day.replace(
+        year=year, month=month, day=min(day.day, calendar.monthrange(year, month)[1])
+    )
+
+
+class RecurringTransaction(models.Model):
+    """Template of an expense repeated on a schedule (rent, subscriptions, bills)"""
+
+    class Frequency(models.TextChoices):
+        WEEKLY = "W", "settimanale"
+        MONTHLY = "M", "mensile"
+        YEARLY = "Y", "annuale"
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
+    description = models.CharField(max_length=200)
+    amount_cents = models.PositiveIntegerField()
+    category = models.ForeignKey(Category, on_delete=models.PROTECT)
+    subcategory = models.ForeignKey(Subcategory, on_delete=models.PROTECT)
+    account = models.ForeignKey(
+        Account, on_delete=models.PROTECT, null=True, blank=True
+    )
+    frequency = models.CharField(
+        max_length=1, choices=Frequency, default=Frequency.MONTHLY
+    )
+    interval = models.PositiveSmallIntegerField(
+        default=1,
+        validators=[MinValueValidator(1)],
+        help_text="Ogni quante settimane, mesi o anni",
+    )
+    start_date = models.DateField(help_text="Data della prima occorrenza")
+    end_date = models.DateField(null=True, blank=True)
+    active = models.BooleanField(default=True)
+    # Date of the last occurrence written, where the next run picks up
+    last_date = models.DateField(null=True, blank=True, editable=False)
+
+    class Meta:
+        verbose_name = "transazione ricorrente"
+        verbose_name_plural = "transazioni ricorrenti"
+        ordering = ["description"]
+
+    def __str__(self):
+        return f"{self.description} ({self.get_frequency_display()})"
+
+    @property
+    def amount(self):
+        return self.amount_cents / 100
+
+    def clean(self):
+        if self.subcategory_id and self.subcategory.category_id != self.category_id:
+            raise ValidationError(
+                {"subcategory": "La sottocategoria non appartiene alla categoria"}
+            )
+        if self.end_date and self.end_date < self.start_date:
+            raise ValidationError(
+                {"end_date": "La data di fine precede quella di inizio"}
+            )
+
+    def occurrence(self, n):
+        """Date of the n-th occurrence, counting from 0"""
+        if self.frequency == self.Frequency.WEEKLY:
+            return self.start_date + timedelta(weeks=n * self.interval)
+        months = (
+            n * self.interval * (12 if self.frequency == self.Frequency.YEARLY else 1)
+        )
+        # Always from the start date, so a 31st is back after a shorter month
+        return add_months(self.start_date, months)
+
+    def due_dates(self, until):
+        """Occurrences after the last one written, up to `until` included"""
+        if self.interval < 1:
+            # Every occurrence would fall on the start date: never ends
+            raise ValueError(f"Invalid interval {self.interval} for {self}")
+        if self.end_date:
+            until = min(until, self.end_date)
+        n = 0
+        while (day := self.occurrence(n)) <= until:
+            if self.last_date is None or day > self.last_date:
+                yield day
+            n += 1
+
+    def client_id(self, day):
+        """Stable idempotency key of the occurrence of a given day"""
+        return uuid.uuid5(uuid.NAMESPACE_URL, f"trantrac:recurring:{self.pk}:{day}")
+
+    def build(self, day):
+        return Transaction(
+            user=self.user,
+            kind=Transaction.Kind.EXPENSE,
+            date=day,
+            amount_cents=self.amount_cents,
+            description=self.description,
+            payer=str(self.user.display_name),
+            category=self.category,
+            subcategory=self.subcategory,
+            account=self.account,
+            client_id=self.client_id(day),
+        )
+
+
+class RequestProfile(models.Model):
+    """Profile of a request run with ?_profile=1 by a staff user"""
+
+    # Older profiles are deleted as new ones come in
+    KEEP = 200
+
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True
+    )
+    method = models.CharField(max_length=10)
+    path = models.CharField(max_length=500)
+    status_code = models.PositiveSmallIntegerField()
+    duration_ms = models.PositiveIntegerField()
+    query_count = models.PositiveIntegerField()
+    query_ms = models.PositiveIntegerField()
+    profiler = models.CharField(max_length=20)
+    report = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "profilo richiesta"
+        verbose_name_plural = "profili richieste"
+        ordering = ["-id"]
+
+    def __str__(self):
+        return f"{self.method} {self.path} ({self.duration_ms} ms)"
+
+    @classmethod
+    def prune(cls):
+        oldest_kept = cls.objects.values_list("pk", flat=True)[cls.KEEP - 1 : cls.KEEP]
+        cls.objects.filter(pk__lt=models.Subquery(oldest_kept)).delete()
@@ -0,0 +1,173 @@
+import json
+import math
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+from collections import Counter
+
+from django.conf import settings
+
+from trantrac.models import Transaction
+
+TOKEN_RE = re.compile(r"[a-z]{3,}")
+
+
+def tokenize(description):
+    """Lowercase, strip accents and keep alphabetic words (no card numbers/dates)"""
+    text = unicodedata.normalize("NFKD", description.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return set(TOKEN_RE.findall(text))
+
+
+class CategoryPredictor:
+    """Naive Bayes over description tokens, learnt incrementally from the ledger.
+
+    The model is a token -> (category, subcategory) count index kept in memory.
+    Workers catch up by learning the expenses recorded after the last one they
+    saw (`last_id`), so every worker converges on the same counts without a
+    retrain, and any of them can write the snapshot loaded at startup.
+    """
+
+    def __init__(self, snapshot_path, snapshot_interval=60):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.label_counts = Counter()
+        self.label_token_counts = Counter()
+        self.token_labels = {}
+        self.last_id = 0
+        self.last_snapshot = time.monotonic()
+        self.dirty = False
+
+    def learn(self, description, label):
+        tokens = tokenize(description)
+        self.label_counts[label] += 1
+        self.label_token_counts[label] += len(tokens)
+        for token in tokens:
+            self.token_labels.setdefault(token, Counter())[label] += 1
+
+    def refresh(self):
+        """Learn the expenses recorded since the last refresh"""
+        with self.lock:
+            new = (
+                Transaction.objects.filter(
+                    pk__gt=self.last_id,
+                    kind=Transaction.Kind.EXPENSE,
+                    category__isnull=False,
+                )
+                .order_by("pk")
+                .values_list("pk", "description", "category_id", "subcategory_id")
+            )
+            for pk, description, category_id, subcategory_id in new.iterator(
+                chunk_size=2000
+            ):
+                self.learn(description, (category_id, subcategory_id))
+                self.last_id = pk
+                self.dirty = True
+
+            if (
+                self.dirty
+                and time.monotonic() - self.last_snapshot > self.snapshot_interval
+            ):
+                self.snapshot()
+
+    def predict(self, description):
+        """Return the most likely (category_id, subcategory_id), or None.
+
+        Only labels seen with at least one of the tokens are scored, so the
+        cost grows with the number of tokens, not with the size of the ledger.
+        """
+        tokens = tokenize(description)
+        with self.lock:
+            candidates = set()
+            for token in tokens:
+                candidates.update(self.token_labels.get(token, ()))
+            if not candidates:
+                return None
+
+            total = sum(self.label_counts.values())
+            vocabulary = len(self.token_labels)
+            best, best_score = None, -math.inf
+            for label in candidates:
+                denominator = self.label_token_counts[label] + vocabulary
+                score = math.log(self.label_counts[label] / total)
+                for token in tokens:
+                    count = self.token_labels.get(token, {}).get(label, 0)
+                    score += math.log((count + 1) / denominator)
+                if score > best_score:
+                    best, best_score = label, score
+            return best
+
+    def snapshot(self):
+        """Atomically write the counts to disk (caller holds the lock)"""
+        data = {
+            "last_id": self.last_id,
+            "labels": [
+                [*label, count, self.label_token_counts[label]]
+                for label, count in self.label_counts.items()
+            ],
+            "tokens": {
+                token: [[*label, count] for label, count in labels.items()]
+                for token, labels in self.token_labels.items()
+            },
+        }
+        # Every worker writes snapshots: each one needs its own temporary file
+        with tempfile.NamedTemporaryFile(
+            "w",
+            dir=os.path.dirname(self.snapshot_path),
+            prefix=f"{os.path.basename(self.snapshot_path)}.",
+            suffix=".tmp",
+            delete=False,
+        ) as file:
+            try:
+                json.dump(data, file, separators=(",", ":"))
+                file.close()
+                os.replace(file.name, self.snapshot_path)
+            except BaseException:
+                os.unlink(file.name)
+                raise
+        self.last_snapshot = time.monotonic()
+        self.dirty = False
+
+    def load(self):
+        try:
+            with open(self.snapshot_path) as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return
+
+        with self.lock:
+            self.last_id = data["last_id"]
+            for category_id, subcategory_id, count, token_count in data["labels"]:
+                label = (category_id, subcategory_id)
+                self.label_counts[label] = count
+                self.label_token_counts[label] = token_count
+            for token, labels in data["tokens"].items():
+                self.token_labels[token] = Counter(
+                    {
+                        (category_id, subcategory_id): count
+                        for category_id, subcategory_id, count in labels
+                    }
+                )
+
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+
+def get_predictor():
+    """Return the process-wide predictor, loading the snapshot on first use"""
+    global _predictor
+    if _predictor is None:
+        with _predictor_lock:
+            if _predictor is None:
+                predictor = CategoryPredictor(
+                    settings.CATEGORY_PREDICTOR_SNAPSHOT,
+                    settings.CATEGORY_PREDICTOR_SNAPSHOT_INTERVAL,
+                )
+                predictor.load()
+                _predictor = predictor
+    return _predictor
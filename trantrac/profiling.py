@@ -0,0 +1,91 @@
+"""Profile single requests on demand, for staff only.
+
+A staff user adds `?_profile=1` to a URL (or sends an `X-Profile` header, e.g.
+with htmx's hx-headers) and the request runs under pyinstrument when it's
+installed, cProfile otherwise. The report is stored with the request's path,
+timing and SQL totals, and listed at /profiles/. Any other request only pays
+for a substring check on the query string and a header lookup.
+"""
+
+import cProfile
+import importlib.util
+import io
+import pstats
+import time
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from trantrac.models import RequestProfile
+
+PROFILE_PARAM = "_profile"
+PROFILE_HEADER = "HTTP_X_PROFILE"
+# Sampling interval for pyinstrument
+SAMPLE_INTERVAL = 0.001  # seconds
+# Functions listed in a cProfile report
+CPROFILE_LIMIT = 60
+
+
+def pyinstrument_available():
+    """pyinstrument gives readable call trees, but is not a required dependency"""
+    return importlib.util.find_spec("pyinstrument") is not None
+
+
+def run_profiled(get_response, request):
+    """Run the request under a profiler, returning (response, profiler, report)"""
+    if pyinstrument_available():
+        from pyinstrument import Profiler
+
+        profiler = Profiler(interval=SAMPLE_INTERVAL, async_mode="disabled")
+        profiler.start()
+        try:
+            response = get_response(request)
+        finally:
+            profiler.stop()
+        return response, "pyinstrument", profiler.output_text(unicode=True)
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        response = get_response(request)
+    finally:
+        profiler.disable()
+    stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stream)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(CPROFILE_LIMIT)
+    return response, "cProfile", stream.getvalue()
+
+
+class ProfilingMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if (
+            PROFILE_PARAM not in request.META.get("QUERY_STRING", "")
+            and PROFILE_HEADER not in request.META
+        ) or not request.user.is_staff:
+            return self.get_response(request)
+
+        # Streaming responses do most of their work while consumed: only what
+        # runs before the first chunk is profiled
+        start = time.perf_counter()
+        with CaptureQueriesContext(connection) as queries:
+            response, profiler, report = run_profiled(self.get_response, request)
+        duration = time.perf_counter() - start
+
+        profile = RequestProfile.objects.create(
+            user=request.user,
+            method=request.method,
+            path=request.get_full_path()[:500],
+            status_code=response.status_code,
+            duration_ms=round(duration * 1000),
+            query_count=len(queries),
+            query_ms=round(sum(float(query["time"]) for query in queries) * 1000),
+            profiler=profiler,
+            report=report,
+        )
+        RequestProfile.prune()
+        response["X-Profile-Url"] = reverse("profile_detail", args=[profile.pk])
+        return response
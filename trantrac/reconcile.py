@@ -0,0 +1,372 @@
+"""Detect and repair drift between the recorded transactions and the sheet.
+
+Every row the app appends has its position recorded (`Transaction.sheet_row`),
+so the ledger doubles as a local copy of what the sheet should contain.
+Checking a sheet then costs two requests, however long it is:
+
+1. one read of the narrow key columns (date and amount) of the rows the app
+   wrote, hashed in blocks of BLOCK_SIZE rows and compared with the hashes of
+   the same blocks computed from the ledger;
+2. one batched read of the full rows of the blocks whose hashes differ (or
+   that hold an unknown row with the key of a recorded one, i.e. a likely
+   duplicate). When the sheet is in sync there are none and it's skipped.
+"""
+
+import hashlib
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db.models import F
+
+from trantrac.bank_csv import parse_csv_date
+from trantrac.models import (
+    ArchivedYear,
+    Subcategory,
+    Transaction,
+    save_category_and_sub_to_sheet,
+)
+from trantrac.sheets import a1_range, get_sheets_service, spreadsheet_values
+from trantrac.utils import sync_transactions
+
+BLOCK_SIZE = 256
+# Sheets serial dates count days from here
+SHEET_EPOCH = date(1899, 12, 30)
+SHEET_KINDS = {
+    "USCITE": Transaction.Kind.EXPENSE,
+    "ENTRATE": Transaction.Kind.INCOME,
+}
+# Columns written by Transaction.to_sheet_row() to each sheet
+SHEET_WIDTHS = {"USCITE": 8, "ENTRATE": 6}
+# Don't repair when most rows look missing: it's a misread, not drift
+MAX_MISSING_RATIO = 0.5
+
+
+def read_ranges(ranges):
+    """Read several ranges with one request, as unformatted values"""
+    response = (
+        spreadsheet_values()
+        .batchGet(
+            spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+            ranges=ranges,
+            valueRenderOption="UNFORMATTED_VALUE",
+            dateTimeRenderOption="SERIAL_NUMBER",
+        )
+        .execute()
+    )
+    return [value_range.get("values", []) for value_range in response["valueRanges"]]
+
+
+def delete_rows(sheet_name, rows):
+    """Delete rows (1-based) from a sheet with a single batchUpdate"""
+    spreadsheets = get_sheets_service().spreadsheets()
+    properties = spreadsheets.get(
+        spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+        fields="sheets(properties(sheetId,title))",
+    ).execute()
+    sheet_id = next(
+        sheet["properties"]["sheetId"]
+        for sheet in properties["sheets"]
+        if sheet["properties"]["title"] == sheet_name
+    )
+    # Bottom-up, so each deletion leaves the indexes of the next ones valid
+    requests = [
+        {
+            "deleteDimension": {
+                "range": {
+                    "sheetId": sheet_id,
+                    "dimension": "ROWS",
+                    "startIndex": row - 1,
+                    "endIndex": row,
+                }
+            }
+        }
+        for row in sorted(rows, reverse=True)
+    ]
+    spreadsheets.batchUpdate(
+        spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
+        body={"requests": requests},
+    ).execute()
+
+
+def cell_text(value):
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip()
+
+
+def cell_date(value):
+    if isinstance(value, int | float):
+        return (SHEET_EPOCH + timedelta(days=int(value))).isoformat()
+    parsed = parse_csv_date(str(value))
+    return parsed.isoformat() if parsed else cell_text(value)
+
+
+def cell_cents(value):
+    if isinstance(value, int | float):
+        return round(value * 100)
+    try:
+        return round(float(str(value).replace(".", "").replace(",", ".")) * 100)
+    except ValueError:
+        return cell_text(value)
+
+
+def normalize_row(values, width):
+    """Comparable form of a row, whether read from the sheet or built locally"""
+    values = [*values, *[""] * (width - len(values))]
+    return (
+        cell_text(values[0]),
+        cell_date(values[1]),
+        cell_cents(values[2]),
+        *(cell_text(value) for value in values[3:width]),
+    )
+
+
+def expected_row(transaction):
+    row = transaction.to_sheet_row()
+    return normalize_row(row, len(row))
+
+
+def digest(items):
+    return hashlib.sha1(repr(items).encode(), usedforsecurity=False).hexdigest()
+
+
+def block_spans(blocks):
+    """Merge sorted block numbers into (first_row, last_row) spans"""
+    spans = []
+    for block in blocks:
+        start, end = block * BLOCK_SIZE + 1, (block + 1) * BLOCK_SIZE
+        if spans and spans[-1][1] == start - 1:
+            spans[-1] = (spans[-1][0], end)
+        else:
+            spans.append((start, end))
+    return spans
+
+
+class SheetReport:
+    def __init__(self, sheet_name):
+        self.sheet_name = sheet_name
+        self.checked = 0
+        self.blocks = 0
+        self.dirty_blocks = 0
+        self.rows_read = 0
+        self.missing = []  # transactions not found in the sheet
+        self.duplicates = []  # sheet rows repeating a recorded row
+        self.relocated = []  # transactions found at another row
+        self.unplaced = 0  # synced before positions were recorded
+        self.located = []
+        self.foreign = 0  # rows not written by the app
+
+    @property
+    def in_sync(self):
+        # Located rows are in place, but their positions still need saving
+        return not (self.missing or self.duplicates or self.relocated or self.located)
+
+
+def live_transactions(sheet_name):
+    """Transactions written to a live tab, leaving out the archived years"""
+    return Transaction.objects.filter(kind=SHEET_KINDS[sheet_name]).exclude(
+        date__year__in=ArchivedYear.years()
+    )
+
+
+def reconcile_sheet(sheet_name, locate=False):
+    """Compare a transaction sheet with the recorded rows, without changing it"""
+    report = SheetReport(sheet_name)
+    transactions = (
+        live_transactions(sheet_name)
+        .filter(sync_state=Transaction.SyncState.SYNCED)
+        .select_related("category", "subcategory", "account")
+    )
+    recorded = {t.sheet_row: t for t in transactions.filter(sheet_row__isnull=False)}
+    report.unplaced = transactions.filter(sheet_row__isnull=True).count()
+    report.checked = len(recorded)
+    width = SHEET_WIDTHS[sheet_name]
+    last_column = chr(ord("A") + width - 1)
+
+    if recorded:
+        first = (min(recorded) - 1) // BLOCK_SIZE * BLOCK_SIZE + 1
+        (narrow,) = read_ranges([a1_range(sheet_name, f"B{first}:C")])
+        report.rows_read += len(narrow)
+        keys = {
+            first + index: normalize_row(["", *values], 3)[1:]
+            for index, values in enumerate(narrow)
+        }
+        expected_keys = {
+            row: expected_row(transaction)[1:3] for row, transaction in recorded.items()
+        }
+        recorded_keys = set(expected_keys.values())
+
+        local, remote = defaultdict(list), defaultdict(list)
+        suspicious = set()
+        for row in range(first, max(max(recorded), first + len(narrow) - 1) + 1):
+            block = (row - 1) // BLOCK_SIZE
+            if row in expected_keys:
+                local[block].append((row, expected_keys[row]))
+                remote[block].append((row, keys.get(row)))
+            elif keys.get(row) in recorded_keys:
+                suspicious.add(block)
+        report.blocks = len(local.keys() | suspicious)
+        dirty = {
+            block for block in local if digest(local[block]) != digest(remote[block])
+        } | suspicious
+        report.dirty_blocks = len(dirty)
+
+        if dirty:
+            # Also read the block before each dirty one: rows deleted by hand
+            # shift the following rows up, across the block boundary
+            first_block = (first - 1) // BLOCK_SIZE
+            spans = block_spans(
+                sorted(dirty | {block - 1 for block in dirty if block > first_block})
+            )
+            ranges = [
+                a1_range(sheet_name, f"A{start}:{last_column}{end}")
+                for start, end in spans
+            ]
+            rows = {}
+            for (start, _), values in zip(spans, read_ranges(ranges), strict=True):
+                for index, row_values in enumerate(values):
+                    rows[start + index] = normalize_row(row_values, width)
+            report.rows_read += len(rows)
+            # Rows past the end of the sheet are missing, not skipped
+            in_spans = {
+                row: transaction
+                for row, transaction in recorded.items()
+                if any(start <= row <= end for start, end in spans)
+            }
+            known = {expected_row(transaction) for transaction in recorded.values()}
+            resolve(report, rows, in_spans, known)
+
+    if locate and report.unplaced:
+        locate_unplaced(report, transactions, recorded, last_column, width)
+    return report
+
+
+def resolve(report, rows, recorded, known):
+    """Match recorded transactions to the rows actually read from the sheet.
+
+    `known` holds the content of every recorded row, so copies of rows written
+    outside the blocks read are still told apart from foreign rows.
+    """
+    positions = defaultdict(list)
+    for row, content in sorted(rows.items()):
+        positions[content].append(row)
+
+    expected = {row: expected_row(t) for row, t in recorded.items()}
+    # Rows still where they were written first, then the ones that moved
+    in_place = {row for row, content in expected.items() if rows.get(row) == content}
+    claimed = set(in_place)
+    for row, content in sorted(expected.items()):
+        if row in in_place:
+            continue
+        candidates = [r for r in positions[content] if r not in claimed]
+        if candidates:
+            claimed.add(candidates[0])
+            report.relocated.append((recorded[row], candidates[0]))
+        else:
+            report.missing.append(recorded[row])
+
+    for row, content in rows.items():
+        if row in claimed:
+            continue
+        if content in known:
+            report.duplicates.append(row)
+        elif any(content[:3]):
+            report.foreign += 1
+
+
+def locate_unplaced(report, transactions, recorded, last_column, width):
+    """Find the rows of transactions synced before positions were recorded.
+
+    This reads the whole sheet once; afterwards the transactions are checked
+    like any other.
+    """
+    (values,) = read_ranges([a1_range(report.sheet_name, f"A1:{last_column}")])
+    report.rows_read += len(values)
+    positions = defaultdict(list)
+    for index, row_values in enumerate(values, start=1):
+        if index not in recorded:
+            positions[normalize_row(row_values, width)].append(index)
+    for transaction in transactions.filter(sheet_row__isnull=True).order_by("pk"):
+        candidates = positions[expected_row(transaction)]
+        if candidates:
+            report.located.append((transaction, candidates.pop(0)))
+        else:
+            report.missing.append(transaction)
+
+
+def repair_sheet(report):
+    """Fix the drift found by `reconcile_sheet`: relocate, dedupe, re-append.
+
+    Return False (and change nothing) when too many rows look missing, which
+    points at a format or locale mismatch rather than at lost rows.
+    """
+    total = report.checked + len(report.located) + report.unplaced
+    if len(report.missing) > max(10, total * MAX_MISSING_RATIO):
+        return False
+
+    moved = report.relocated + report.located
+    for transaction, row in moved:
+        transaction.sheet_row = row
+    Transaction.objects.bulk_update(
+        [transaction for transaction, _ in moved], ["sheet_row"], batch_size=500
+    )
+
+    if report.duplicates:
+        delete_rows(report.sheet_name, report.duplicates)
+        transactions = live_transactions(report.sheet_name)
+        for row in sorted(report.duplicates, reverse=True):
+            transactions.filter(sheet_row__gt=row).update(sheet_row=F("sheet_row") - 1)
+
+    if report.missing:
+        Transaction.objects.filter(pk__in=[t.pk for t in report.missing]).update(
+            sync_state=Transaction.SyncState.PENDING, sheet_row=None
+        )
+        sync_transactions(report.missing)
+    return True
+
+
+class CategoryReport:
+    def __init__(self):
+        self.sheet_name = "CATEGORIE"
+        self.checked = 0
+        self.missing = []  # (category, subcategory) pairs absent from the sheet
+        self.duplicates = []  # sheet rows repeating a pair
+        self.only_in_sheet = []
+
+    @property
+    def in_sync(self):
+        return not (self.missing or self.duplicates)
+
+
+def reconcile_categories():
+    """Compare the CATEGORIE sheet with the local subcategories.
+
+    The sheet has just two short columns, so it's read whole in one request.
+    """
+    (values,) = read_ranges(["CATEGORIE!A2:B"])
+    report = CategoryReport()
+    seen = Counter()
+    for index, row_values in enumerate(values, start=2):
+        pair = tuple(cell_text(value) for value in [*row_values, "", ""][:2])
+        if not pair[0]:
+            continue
+        seen[pair] += 1
+        if seen[pair] > 1:
+            report.duplicates.append(index)
+
+    local = set(Subcategory.objects.values_list("category__name", "name"))
+    report.checked = len(local)
+    report.missing = sorted(local - seen.keys())
+    report.only_in_sheet = sorted(
+        pair for pair in seen if pair[1] and pair not in local
+    )
+    return report
+
+
+def repair_categories(report):
+    if report.duplicates:
+        delete_rows(report.sheet_name, report.duplicates)
+    if report.missing:
+        save_category_and_sub_to_sheet([list(pair) for pair in report.missing])
+    return True
@@ -0,0 +1,58 @@
+from functools import lru_cache
+
+from django.conf import settings
+
+
+@lru_cache(maxsize=1)
+def get_sheets_service():
+    """Get the process-wide service object for the Sheets API.
+
+    Its HTTP connection isn't thread-safe: code running outside the request
+    threads (e.g. the health probe) builds its own with `build_sheets_service`.
+    """
+    return build_sheets_service()
+
+
+def build_sheets_service():
+    """Build a new service object for interacting with the Sheets API.
+
+    The Google client libraries are imported here rather than at module level:
+    they add ~80ms and several MB to every process that imports the app
+    (workers, migrate, collectstatic, cron commands), while only the code paths
+    that actually talk to Sheets need them.
+    """
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+
+    credentials = service_account.Credentials.from_service_account_info(
+        settings.GOOGLE_SHEETS_CREDENTIALS, scopes=settings.SCOPES
+    )
+    return build("sheets", "v4", credentials=credentials)
+
+
+def api_errors():
+    """Exceptions a Sheets call raises when the API or the network fails.
+
+    A function rather than a constant, for the same reason the client
+    libraries are imported lazily in `build_sheets_service`.
+    """
+    from google.auth.exceptions import GoogleAuthError
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+
+    return (HttpError, GoogleAuthError, HttpLib2Error, OSError)
+
+
+def spreadsheet_values():
+    """Shortcut to the `spreadsheets().values()` resource"""
+    return get_sheets_service().spreadsheets().values()
+
+
+def a1_range(sheet_name, cells):
+    """A1 notation for `cells` of a tab, quoting the tab's name.
+
+    Names with spaces (the per-year tabs, e.g. "USCITE 2024") are only
+    accepted quoted, with any quote doubled.
+    """
+    quoted = sheet_name.replace("'", "''")
+    return f"'{quoted}'!{cells}"
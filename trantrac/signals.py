@@ -0,0 +1,38 @@
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from trantrac.cache import ACCOUNTS, CATEGORIES, QUICK_PICKS, SPENDING, invalidate
+from trantrac.models import (
+    Account,
+    Category,
+    CategoryUsage,
+    MonthlySpending,
+    Subcategory,
+)
+
+
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=Subcategory)
+def invalidate_categories(sender, **kwargs):
+    invalidate(CATEGORIES, QUICK_PICKS)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_spending(sender, **kwargs):
+    # Cached monthly totals are keyed by category and account name
+    invalidate(SPENDING)
+
+
+@receiver([post_save, post_delete], sender=Account)
+def invalidate_accounts(sender, **kwargs):
+    invalidate(ACCOUNTS, SPENDING)
+
+
+@receiver(pre_delete, sender=Account)
+def detach_account_spending(sender, instance, **kwargs):
+    MonthlySpending.detach_account(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=CategoryUsage)
+def invalidate_quick_picks(sender, **kwargs):
+    invalidate(QUICK_PICKS)
@@ -4,9 +4,23 @@ from trantrac import views
 
 urlpatterns = [
     path("", views.index, name="index"),
+    path("receipt/", views.receipt, name="receipt"),
     path("add_category/", views.add_category, name="add_category"),
     path("add-subcategory/", views.add_subcategory, name="add_subcategory"),
     path("upload_csv/", views.upload_csv, name="upload_csv"),
+    path("upload_csv/confirm/", views.confirm_csv_import, name="confirm_csv_import"),
     path("load_subcategory/", views.load_subcategories, name="load_subcategories"),
+    path("predict-category/", views.predict_category, name="predict_category"),
     path("refresh-categories/", views.refresh_categories, name="refresh_categories"),
+    path("history/", views.history, name="history"),
+    path("search/", views.search, name="search"),
+    path("export/", views.export_transactions, name="export_transactions"),
+    path("dashboard/", views.dashboard, name="dashboard"),
+    path("api/categories/", views.category_map, name="category_map"),
+    path("api/transactions/", views.ingest_transactions, name="ingest_transactions"),
+    path("sw.js", views.service_worker, name="service_worker"),
+    path("profiles/", views.profiles, name="profiles"),
+    path("profiles/<int:pk>/", views.profile_detail, name="profile_detail"),
+    path("healthz", views.healthz, name="healthz"),
+    path("readyz", views.readyz, name="readyz"),
 ]
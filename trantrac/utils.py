@@ -1,25 +1,89 @@
 import csv
-from functools import lru_cache
-from io import TextIOWrapper
+import importlib.util
+import multiprocessing
+import os
+import re
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+from io import StringIO
+from itertools import batched
+from operator import itemgetter
 
 from django.conf import settings
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-
-from trantrac.models import Category, Subcategory, save_category_and_sub_to_sheet
-
-
-@lru_cache(maxsize=1)
-def get_sheets_service():
-    """ " Get a service object for interacting with the Sheets API"""
-    credentials = service_account.Credentials.from_service_account_info(
-        settings.GOOGLE_SHEETS_CREDENTIALS, scopes=settings.SCOPES
-    )
-    return build("sheets", "v4", credentials=credentials)
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection
+from django.db import transaction as db_transaction
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from trantrac.bank_csv import (
+    UPLOAD_MAX_UNCOMPRESSED_SIZE,
+    CsvImportError,
+    expand_zip,
+    parse_bank_file,
+)
+from trantrac.cache import CATEGORIES, SPENDING, cached, invalidate
+from trantrac.models import (
+    Account,
+    ArchivedYear,
+    Category,
+    MonthlySpending,
+    Subcategory,
+    Transaction,
+    save_category_and_sub_to_sheet,
+)
+from trantrac.predictor import get_predictor
+from trantrac.sheets import a1_range, api_errors, get_sheets_service
+
+# Account used for expenses imported from the shared bank account
+SHARED_ACCOUNT = "Comune"
+
+UPDATED_RANGE_RE = re.compile(r"![A-Z]+(\d+)")
+SHEET_APPEND_MAX_ROWS = 2000
+
+# Private-use characters marking FTS matches, swapped for <mark> after escaping
+MATCH_START, MATCH_END = "\ue000", "\ue001"
+# Triggers keeping trantrac_transaction_fts in sync (migrations 0005 and 0014)
+FTS_TRIGGERS = (
+    "trantrac_transaction_fts_insert",
+    "trantrac_transaction_fts_delete",
+    "trantrac_transaction_fts_update",
+)
+
+# Label for expenses recorded without a bank account
+NO_ACCOUNT = "Senza conto"
+
+# Columns of the exported transactions, and the fields they're read from
+EXPORT_COLUMNS = (
+    ("id", "id"),
+    ("data", "date"),
+    ("tipo", "kind"),
+    ("importo", "amount_cents"),
+    ("descrizione", "description"),
+    ("pagante", "payer"),
+    ("categoria", "category__name"),
+    ("sottocategoria", "subcategory__name"),
+    ("conto", "account__name"),
+    ("categoria_banca", "bank_category"),
+    ("id_esterno", "external_id"),
+)
+EXPORT_CHUNK_SIZE = 2000
+
+
+def format_cents(amount_cents):
+    """Format an amount in cents the way the sheet does (e.g. 1234,50)"""
+    return f"{amount_cents / 100:.2f}".replace(".", ",")
 
 
 def save_to_sheet(values, sheet_name):
-    """Save data to Google Sheets, appending to the first empty row"""
+    """Save data to Google Sheets, appending to the first empty row.
+
+    Return the number of the first row written, or None if the sheet didn't
+    take all the rows.
+    """
     service = get_sheets_service()
 
     # Get the current length of data in the sheet
@@ -28,7 +92,7 @@ def save_to_sheet(values, sheet_name):
         .values()
         .get(
             spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
-            range=f"{sheet_name}!A:C",
+            range=a1_range(sheet_name, "A:C"),
         )
         .execute()
     )
@@ -42,7 +106,7 @@ def save_to_sheet(values, sheet_name):
         .values()
         .append(
             spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
-            range=f"{sheet_name}!A{start_row}:C{start_row}",
+            range=a1_range(sheet_name, f"A{start_row}:C{start_row}"),
             valueInputOption="USER_ENTERED",
             insertDataOption="INSERT_ROWS",
             body=body,
@@ -50,133 +114,257 @@ def save_to_sheet(values, sheet_name):
         .execute()
     )
 
-    expected_rows = len(values)
-    return result.get("updates").get("updatedRows") == expected_rows
+    updates = result.get("updates")
+    if updates.get("updatedRows") != len(values):
+        return None
+    # updatedRange looks like "USCITE!A120:H125" or "'USCITE 2024'!A5:H5"
+    return int(UPDATED_RANGE_RE.search(updates["updatedRange"]).group(1))
 
 
-def import_csv_to_sheet(csv_file, user):
-    """Import CSV file to Google Sheets separating positive and negative transactions"""
-    REQUIRED_COLUMNS = {
-        "Data operazione",
-        "Importo",
-        "Descrizione",
-        "Categoria",
-        "Sottocategoria",
-        "Codice identificativo",
-    }
+# Below this total size the files are parsed in this process: starting the
+# worker processes would take longer than the parsing itself
+PARALLEL_PARSE_MIN_BYTES = 1024 * 1024
+PARSE_MAX_WORKERS = 4
 
-    file = TextIOWrapper(csv_file.file, encoding="utf-8")
-    csv_reader = csv.DictReader(file)
 
-    if missing_columns := REQUIRED_COLUMNS - set(csv_reader.fieldnames):
-        return (
-            False,
-            f"Il file CSV non contiene le seguenti colonne: {', '.join(missing_columns)}",
+def parse_bank_files(files):
+    """Parse (name, data) uploads, CSV files or ZIPs of them, one result per CSV.
+
+    Results are (name, rows, error) tuples: a file that can't be parsed gets
+    an error without stopping the others. Large uploads are parsed in a pool
+    of processes, as parsing is CPU bound.
+    """
+    sources, failed = [], []
+    # What the ZIPs can still expand to, after the plain CSV files
+    budget = UPLOAD_MAX_UNCOMPRESSED_SIZE - sum(
+        len(data) for name, data in files if not name.lower().endswith(".zip")
+    )
+    for name, data in files:
+        if not name.lower().endswith(".zip"):
+            sources.append((name, data))
+            continue
+        try:
+            expanded = expand_zip(name, data, max_size=max(budget, 0))
+        except CsvImportError as e:
+            failed.append((name, [], str(e)))
+        else:
+            sources += expanded
+            budget -= sum(len(content) for _, content in expanded)
+
+    names = [name for name, _ in sources]
+    contents = [data for _, data in sources]
+    workers = min(len(sources), PARSE_MAX_WORKERS, os.cpu_count() or 1)
+    if workers > 1 and sum(map(len, contents)) >= PARALLEL_PARSE_MIN_BYTES:
+        # Spawned rather than forked: forking a threaded server process is unsafe
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as pool:
+            results = list(pool.map(parse_bank_file, names, contents))
+    else:
+        results = list(map(parse_bank_file, names, contents))
+    return failed + results
+
+
+def preview_bank_files(files):
+    """Parse uploads and preview the import of all their rows, merged by date"""
+    results = parse_bank_files(files)
+    rows = sorted(
+        (row for _, file_rows, _ in results for row in file_rows), key=itemgetter(0)
+    )
+    preview = preview_import(rows)
+    preview["files"] = [
+        (name, len(file_rows), error) for name, file_rows, error in results
+    ]
+    return preview
+
+
+def preview_import(rows):
+    """Work out what importing parsed rows would change, without writing anything.
+
+    The result only holds plain values, so it can be cached between the
+    preview and the confirmation of an import.
+    """
+    pairs = {(category, sub) for _, cents, _, category, sub, _ in rows if cents < 0}
+    names = {category for category, _ in pairs}
+    existing_categories = set(
+        Category.objects.filter(name__in=names).values_list("name", flat=True)
+    )
+    existing_pairs = set(
+        Subcategory.objects.filter(category__name__in=names).values_list(
+            "category__name", "name"
         )
+    )
+
+    # Rows recorded by a previous import of an overlapping file, or repeated
+    recorded = set(
+        Transaction.objects.filter(
+            external_id__in={row[5] for row in rows} - {""}
+        ).values_list("external_id", flat=True)
+    )
+    duplicates = []
+    for index, row in enumerate(rows):
+        if external_id := row[5]:
+            if external_id in recorded:
+                duplicates.append(index)
+            recorded.add(external_id)
+
+    skipped = set(duplicates)
+    kept = [row for index, row in enumerate(rows) if index not in skipped]
+    return {
+        "rows": rows,
+        "duplicates": duplicates,
+        "income": sum(1 for row in kept if row[1] >= 0),
+        "expenses": sum(1 for row in kept if row[1] < 0),
+        "income_cents": sum(row[1] for row in kept if row[1] >= 0),
+        "expense_cents": -sum(row[1] for row in kept if row[1] < 0),
+        "date_from": min((row[0] for row in rows), default=None),
+        "date_to": max((row[0] for row in rows), default=None),
+        "new_categories": sorted(names - existing_categories),
+        "new_subcategories": sorted(
+            pair for pair in pairs if pair[1] and pair not in existing_pairs
+        ),
+    }
 
-    categories_subcategories = set()
-    positive_values = []
-    negative_values = []
 
-    for row in csv_reader:
-        if not any(row.values()) or any("Saldo" in value for value in row.values()):
-            continue
+def apply_import(preview, user):
+    """Write a previewed import: new categories first, then the transactions"""
+    skipped = set(preview["duplicates"])
+    rows = [row for index, row in enumerate(preview["rows"]) if index not in skipped]
+    # Another import may have recorded some of the rows since the preview
+    recorded = set(
+        Transaction.objects.filter(
+            external_id__in={row[5] for row in rows} - {""}
+        ).values_list("external_id", flat=True)
+    )
+    rows = [row for row in rows if not row[5] or row[5] not in recorded]
 
-        importo = row["Importo"].replace("+", "").strip()
-        try:
-            importo_float = float(importo.replace(".", "").replace(",", "."))
-        except ValueError:
-            return (
-                False,
-                "Il file CSV contiene valori non numerici nella colonna Importo.",
-            )
+    names = {category for _, cents, _, category, _, _ in rows if cents < 0}
+    categories = {c.name: c for c in Category.objects.filter(name__in=names)}
+    new_categories = [Category(name=name) for name in sorted(names - categories.keys())]
+    Category.objects.bulk_create(new_categories)
+    categories.update((category.name, category) for category in new_categories)
+
+    subcategories = {
+        (sub.category.name, sub.name): sub
+        for sub in Subcategory.objects.filter(
+            category__in=categories.values()
+        ).select_related("category")
+    }
+    new_subcategories = [
+        Subcategory(name=sub, category=categories[category], skip_sheet_save=True)
+        for category, sub in preview["new_subcategories"]
+        if category in categories and (category, sub) not in subcategories
+    ]
+    Subcategory.objects.bulk_create(new_subcategories)
+    subcategories.update(
+        ((sub.category.name, sub.name), sub) for sub in new_subcategories
+    )
+    if new_categories or new_subcategories:
+        # bulk_create doesn't send post_save
+        invalidate(CATEGORIES)
+    if new_subcategories:
+        save_category_and_sub_to_sheet(
+            [[sub.category.name, sub.name] for sub in new_subcategories]
+        )
 
-        description = row["Descrizione"]
-        if importo_float >= 0:
+    shared_account, _ = Account.objects.get_or_create(name=SHARED_ACCOUNT)
+    transactions = []
+    for date, cents, description, category, sub, external_id in rows:
+        transaction = Transaction(
+            user=user,
+            date=date,
+            amount_cents=abs(cents),
+            description=description,
+            external_id=external_id,
+        )
+        if cents >= 0:
             # Determine user name based on description for positive transactions
             if "VIVIANA" in description:
-                display_name = "Viviana"
+                transaction.payer = "Viviana"
             elif "ENRICO" in description or "APPLE" in description:
-                display_name = "Enrico"
+                transaction.payer = "Enrico"
             else:
-                display_name = "Altro"
-
-            transaction_row = [
-                display_name,
-                str(row["Data operazione"]),
-                importo,
-                (description[:47] + "...") if len(description) > 50 else description,
-                row["Categoria"],
-                row["Codice identificativo"],
-            ]
-            positive_values.append(transaction_row)
+                transaction.payer = "Altro"
+            transaction.kind = Transaction.Kind.INCOME
+            transaction.bank_category = category
         else:
-            transaction_row = [
-                str(user.display_name),
-                str(row["Data operazione"]),
-                importo.replace("-", ""),
-                (description[:47] + "...") if len(description) > 50 else description,
-                row["Categoria"],
-                row["Sottocategoria"],
-                "Comune",
-                row["Codice identificativo"],
-            ]
-            negative_values.append(transaction_row)
-            categories_subcategories.add((row["Categoria"], row["Sottocategoria"]))
-
-    # Bulk create categories for negative transactions only
-    existing_categories = {
-        cat.name: cat
-        for cat in Category.objects.filter(
-            name__in=[cat_name for cat_name, _ in categories_subcategories]
+            transaction.payer = str(user.display_name)
+            transaction.kind = Transaction.Kind.EXPENSE
+            transaction.category = categories[category]
+            transaction.subcategory = subcategories.get((category, sub))
+            transaction.account = shared_account
+        transactions.append(transaction)
+
+    success = record_transactions(transactions)
+    skipped = len(preview["rows"]) - len(transactions)
+
+    if not success:
+        return (False, "Ops, qualcosa è andato storto..")
+    if skipped:
+        return (
+            True,
+            f"File importato con successo ({skipped} transazioni già presenti ignorate)",
         )
-    }
+    return (True, "File importato con successo")
 
-    new_categories = []
-    for cat_name, _ in categories_subcategories:
-        if cat_name not in existing_categories:
-            new_cat = Category(name=cat_name)
-            new_categories.append(new_cat)
-            existing_categories[cat_name] = new_cat
 
-    Category.objects.bulk_create(new_categories)
+def record_transactions(transactions):
+    """Save transactions locally, update the rollups and replicate them to the sheet.
 
-    # Handle subcategories for negative transactions only
-    existing_subcategories = {
-        (sub.name, sub.category.name): sub
-        for sub in Subcategory.objects.filter(
-            category__in=existing_categories.values()
-        ).select_related("category")
-    }
+    The local rows are the source of truth: they are kept even when the sheet
+    can't be reached, marked as failed so `sync_transactions` can retry them.
+    """
+    with db_transaction.atomic():
+        Transaction.objects.bulk_create(transactions)
+        MonthlySpending.record(
+            (t.user_id, t.date, t.category_id, t.account_id, t.amount_cents)
+            for t in transactions
+            if t.kind == Transaction.Kind.EXPENSE and t.category_id
+        )
+    get_predictor().refresh()
+    return sync_transactions(transactions)
 
-    subcategories_sheet_values = []
 
-    for cat_name, subcat_name in categories_subcategories:
-        if not subcat_name:
-            continue
+def sync_transactions(transactions):
+    """Append transactions to their sheets and track the result.
 
-        if (subcat_name, cat_name) not in existing_subcategories:
-            subcategory = Subcategory(
-                name=subcat_name,
-                category=existing_categories[cat_name],
-                skip_sheet_save=True,
-            )
-            subcategory.save()
-            subcategories_sheet_values.append([cat_name, subcat_name])
+    Each sheet gets one append per SHEET_APPEND_MAX_ROWS rows, which keeps
+    large imports within the API's request size.
+    """
+    archived_years = ArchivedYear.years()
+    by_sheet = {}
+    for transaction in transactions:
+        sheet_name = transaction.target_sheet(archived_years)
+        by_sheet.setdefault(sheet_name, []).append(transaction)
 
-    if subcategories_sheet_values:
-        save_category_and_sub_to_sheet(subcategories_sheet_values)
+    success = True
+    for sheet_name, all_transactions in by_sheet.items():
+        for batch in batched(all_transactions, SHEET_APPEND_MAX_ROWS):
+            success = append_transactions(sheet_name, list(batch)) and success
+    return success
 
-    # Save transactions to respective sheets
-    success_positive = save_to_sheet(positive_values, "ENTRATE")
-    success_negative = save_to_sheet(negative_values, "USCITE")
 
-    return (
-        success_positive and success_negative,
-        "File importato con successo"
-        if (success_positive and success_negative)
-        else "Ops, qualcosa è andato storto..",
+def append_transactions(sheet_name, transactions):
+    """Append transactions to a sheet with one request, recording their rows"""
+    try:
+        first_row = save_to_sheet([t.to_sheet_row() for t in transactions], sheet_name)
+    except api_errors():
+        first_row = None
+
+    if first_row is None:
+        Transaction.objects.filter(pk__in=[t.pk for t in transactions]).update(
+            sync_state=Transaction.SyncState.FAILED
+        )
+        return False
+
+    # Rows are appended in order: remember where each one landed
+    for offset, transaction in enumerate(transactions):
+        transaction.sync_state = Transaction.SyncState.SYNCED
+        transaction.sheet_row = first_row + offset
+    Transaction.objects.bulk_update(
+        transactions, ["sync_state", "sheet_row"], batch_size=500
     )
+    return True
 
 
 def get_sheet_data(sheet_name, range_name):
@@ -189,11 +377,188 @@ def get_sheet_data(sheet_name, range_name):
             sheet.values()
             .get(
                 spreadsheetId=settings.GOOGLE_SHEETS_SPREADSHEET_ID,
-                range=f"{sheet_name}!{range_name}",
+                range=a1_range(sheet_name, range_name),
             )
             .execute()
         )
 
         return result.get("values", [])
-    except Exception:
+    except api_errors():
         return None
+
+
+def missing_fts_triggers():
+    """FTS triggers missing from the database, e.g. dropped by a table rebuild"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND name IN "
+            f"({', '.join(['%s'] * len(FTS_TRIGGERS))})",  # nosec B608
+            FTS_TRIGGERS,
+        )
+        present = {name for (name,) in cursor.fetchall()}
+    return [name for name in FTS_TRIGGERS if name not in present]
+
+
+_fts_triggers_checked = False
+
+
+def search_transactions(query, limit=20):
+    """Full-text search over transaction descriptions, best matches first.
+
+    Returns (transaction, snippet) pairs, where the snippet is safe HTML with
+    the matching words wrapped in <mark>. Raises ImproperlyConfigured if the
+    index isn't kept up to date, rather than silently missing results.
+    """
+    global _fts_triggers_checked
+    if not _fts_triggers_checked:
+        if missing := missing_fts_triggers():
+            raise ImproperlyConfigured(
+                f"Full-text search triggers missing: {', '.join(missing)}"
+            )
+        # Only a migration can drop them, and workers restart after one
+        _fts_triggers_checked = True
+    tokens = [token.replace('"', "") for token in query.split()]
+    tokens = [token for token in tokens if token]
+    if not tokens:
+        return []
+    # Quote every token so user input can't inject FTS syntax, and prefix
+    # match the terms so results show up while the user is still typing
+    match = " ".join(f'"{token}"*' for token in tokens)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT rowid, snippet(trantrac_transaction_fts, 0, %s, %s, '…', 12)
+            FROM trantrac_transaction_fts
+            WHERE trantrac_transaction_fts MATCH %s
+            ORDER BY rank
+            LIMIT %s
+            """,
+            [MATCH_START, MATCH_END, match, limit],
+        )
+        hits = cursor.fetchall()
+
+    transactions = Transaction.objects.select_related(
+        "category", "subcategory", "account"
+    ).in_bulk([pk for pk, _ in hits])
+    return [
+        (
+            transactions[pk],
+            mark_safe(  # nosec B308 B703
+                escape(snippet)
+                .replace(MATCH_START, "<mark>")
+                .replace(MATCH_END, "</mark>")
+            ),
+        )
+        for pk, snippet in hits
+        if pk in transactions
+    ]
+
+
+def summarize_month(month):
+    """Total, count and per-category/per-account totals of a month's expenses"""
+    rows = (
+        MonthlySpending.objects.filter(month=month)
+        .values("category__name", "account__name")
+        .annotate(total=Sum("total_cents"), expenses=Sum("count"))
+        .order_by()
+    )
+    categories, accounts = Counter(), Counter()
+    count = 0
+    for row in rows:
+        categories[row["category__name"]] += row["total"]
+        accounts[row["account__name"] or NO_ACCOUNT] += row["total"]
+        count += row["expenses"]
+    return {
+        "month": month,
+        "total_cents": sum(categories.values()),
+        "count": count,
+        "categories": categories,
+        "accounts": accounts,
+    }
+
+
+def get_month_spending(month):
+    """Spending summary of a month, read from the monthly rollups.
+
+    Closed months are cached with no expiry: `MonthlySpending.record` forgets
+    a month when back-dated expenses land in it. The current month changes on
+    every expense and is recomputed, which is a single small aggregate query.
+    """
+    if month >= timezone.localdate().replace(day=1):
+        return summarize_month(month)
+    return cached(
+        SPENDING, f"{month:%Y-%m}", lambda: summarize_month(month), timeout=None
+    )
+
+
+def filter_transactions(
+    transactions, account=None, category=None, date_from=None, date_to=None
+):
+    """Apply the history/export filters to a Transaction queryset"""
+    if account:
+        transactions = transactions.filter(account=account)
+    if category:
+        transactions = transactions.filter(category=category)
+    if date_from:
+        transactions = transactions.filter(date__gte=date_from)
+    if date_to:
+        transactions = transactions.filter(date__lte=date_to)
+    return transactions
+
+
+def export_rows(transactions, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the export columns of each transaction, oldest first.
+
+    Rows are fetched `chunk_size` at a time from an open cursor rather than
+    loaded into a list, so memory stays flat whatever the size of the ledger.
+    """
+    kinds = dict(Transaction.Kind.choices)
+    rows = (
+        transactions.order_by("date", "id")
+        .values_list(*(field for _, field in EXPORT_COLUMNS))
+        .iterator(chunk_size=chunk_size)
+    )
+    for pk, date, kind, amount_cents, *text in rows:
+        yield (pk, date, kinds[kind], amount_cents, *(value or "" for value in text))
+
+
+def export_csv(transactions, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield the transactions as CSV text, one chunk of rows at a time"""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(column for column, _ in EXPORT_COLUMNS)
+    for batch in batched(export_rows(transactions, chunk_size), chunk_size):
+        writer.writerows(
+            (pk, date.isoformat(), kind, f"{amount_cents / 100:.2f}", *text)
+            for pk, date, kind, amount_cents, *text in batch
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def parquet_available():
+    """Parquet export needs pyarrow, which is not a required dependency"""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def export_parquet(transactions, file, chunk_size=EXPORT_CHUNK_SIZE):
+    """Write the transactions to `file` as Parquet, one row group per chunk"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    text = pa.string()
+    types = [pa.int64(), pa.date32(), text, pa.decimal128(12, 2)]
+    types += [text] * (len(EXPORT_COLUMNS) - len(types))
+    schema = pa.schema(
+        [(column, type_) for (column, _), type_ in zip(EXPORT_COLUMNS, types)]
+    )
+
+    with pq.ParquetWriter(file, schema, compression="zstd") as writer:
+        for batch in batched(export_rows(transactions, chunk_size), chunk_size):
+            columns = list(zip(*batch))
+            columns[3] = [Decimal(cents).scaleb(-2) for cents in columns[3]]
+            writer.write_batch(pa.record_batch(columns, schema=schema))
@@ -1,37 +1,114 @@
+import datetime
+import hashlib
+import json
+import re
+import tempfile
+from collections import Counter
+
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
-from django.db.models import Count
-from django.http import HttpResponse
-from django.shortcuts import redirect
+from django.core.cache import cache
+from django.db import IntegrityError
+from django.db.models import Prefetch, Q, Sum
+from django.http import FileResponse, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
 from django.template.response import TemplateResponse
+from django.templatetags.static import static
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_POST
+
+from trantrac.cache import CATEGORIES, QUICK_PICKS, cached, invalidate
+from trantrac.forms import (
+    CategoryForm,
+    CsvUploadForm,
+    HistoryFilterForm,
+    IngestTransactionForm,
+    ReceiptForm,
+    ReceiptRowFormSet,
+    ReceiptRowFormSetHelper,
+    SubcategoryForm,
+    TransactionForm,
+    default_account,
+)
+from trantrac.health import readiness, uptime
+from trantrac.models import (
+    Account,
+    Category,
+    CategoryUsage,
+    RequestProfile,
+    Subcategory,
+    Transaction,
+)
+from trantrac.predictor import get_predictor
+from trantrac.profiling import PROFILE_PARAM
+from trantrac.utils import (
+    apply_import,
+    export_csv,
+    export_parquet,
+    filter_transactions,
+    format_cents,
+    get_month_spending,
+    get_sheet_data,
+    parquet_available,
+    preview_bank_files,
+    preview_import,
+    record_transactions,
+    search_transactions,
+)
+
+HISTORY_PAGE_SIZE = 50
+DASHBOARD_MONTHS = 12
+INGEST_MAX_ROWS = 100
+# Time to confirm an import after its preview
+IMPORT_PREVIEW_TIMEOUT = 30 * 60
+IMPORT_DIGEST_RE = re.compile(r"[0-9a-f]{64}")
 
-from trantrac.forms import CategoryForm, CsvUploadForm, SubcategoryForm, TransactionForm
-from trantrac.models import Category, CategoryUsage, Subcategory
-from trantrac.utils import import_csv_to_sheet, save_to_sheet, get_sheet_data
+# Static files cached by the service worker to open the entry form offline
+OFFLINE_ASSETS = (
+    "css/tailwind.css",
+    "css/custom.css",
+    "js/htmx.min.js",
+    "js/alpine-collapse.min.js",
+    "js/alpine.min.js",
+    "js/offline.js",
+    "img/favicon.svg",
+    "img/favicon-96x96.png",
+)
 
 
 def get_recent_categories(limit=6):
     """Get last N used category+subcategory pairs (global)"""
     from django.db.models import Max
 
-    return (
-        CategoryUsage.objects.values(
-            "category", "subcategory", "subcategory__name", "category__name"
-        )
-        .annotate(last_used=Max("created_at"))
-        .order_by("-last_used")[:limit]
+    return cached(
+        QUICK_PICKS,
+        f"recent:{limit}",
+        lambda: list(
+            CategoryUsage.objects.values(
+                "category", "subcategory", "subcategory__name", "category__name"
+            )
+            .annotate(last_used=Max("created_at"))
+            .order_by("-last_used")[:limit]
+        ),
     )
 
 
 def get_most_used_categories(limit=6):
     """Get top N most used category+subcategory pairs (global)"""
-    return (
-        CategoryUsage.objects.values(
-            "category", "subcategory", "subcategory__name", "category__name"
-        )
-        .annotate(usage_count=Count("id"))
-        .order_by("-usage_count")[:limit]
+    return cached(
+        QUICK_PICKS,
+        f"most_used:{limit}",
+        lambda: list(
+            CategoryUsage.objects.values(
+                "category", "subcategory", "subcategory__name", "category__name"
+            )
+            .annotate(usage_count=Sum("count"))
+            .order_by("-usage_count")[:limit]
+        ),
     )
 
 
@@ -40,25 +117,25 @@ def index(request):
     if request.method == "POST":
         form = TransactionForm(request.POST, user=request.user)
         if form.is_valid():
-            values = [
-                [
-                    str(request.user.display_name),
-                    form.cleaned_data["date"].strftime("%Y-%m-%d"),
-                    str(form.cleaned_data["amount"]).replace(".", ","),
-                    str(form.cleaned_data["description"]),
-                    str(form.cleaned_data["category"]),
-                    str(form.cleaned_data["subcategory"]),
-                    str(form.cleaned_data["bank_account"]),
-                ]
-            ]
-
-            if save_to_sheet(values, "USCITE"):
-                # Track category usage
-                CategoryUsage.objects.create(
-                    user=request.user,
-                    category=form.cleaned_data["category"],
-                    subcategory=form.cleaned_data["subcategory"],
-                )
+            transaction = Transaction(
+                user=request.user,
+                kind=Transaction.Kind.EXPENSE,
+                date=form.cleaned_data["date"],
+                amount_cents=int(form.cleaned_data["amount"] * 100),
+                description=form.cleaned_data["description"],
+                payer=str(request.user.display_name),
+                category=form.cleaned_data["category"],
+                subcategory=form.cleaned_data["subcategory"],
+                account=form.cleaned_data["bank_account"],
+            )
+            # Track category usage
+            CategoryUsage.objects.create(
+                user=request.user,
+                category=form.cleaned_data["category"],
+                subcategory=form.cleaned_data["subcategory"],
+            )
+
+            if record_transactions([transaction]):
                 messages.add_message(
                     request,
                     messages.SUCCESS,
@@ -67,8 +144,8 @@ def index(request):
             else:
                 messages.add_message(
                     request,
-                    messages.ERROR,
-                    "Ops.. qualcosa è andato storto",
+                    messages.WARNING,
+                    "Transazione salvata, ma non ancora sincronizzata con il foglio",
                 )
             return HttpResponse(status=204, headers={"HX-Refresh": "true"})
 
@@ -92,6 +169,72 @@ def index(request):
         return TemplateResponse(request, "trantrac/index.html", context)
 
 
+@login_required
+def receipt(request):
+    """Enter several expenses sharing date, description and account at once.
+
+    All rows are validated together, then saved with one bulk insert and
+    replicated with a single append, so a long receipt costs about as much
+    as a single expense.
+    """
+    form = ReceiptForm(request.POST or None, user=request.user)
+    formset = ReceiptRowFormSet(request.POST or None)
+    if request.method == "POST" and form.is_valid() and formset.is_valid():
+        date = form.cleaned_data["date"]
+        description = form.cleaned_data["description"]
+        account = form.cleaned_data["bank_account"]
+        rows = [row.cleaned_data for row in formset if row.cleaned_data]
+        transactions = [
+            Transaction(
+                user=request.user,
+                kind=Transaction.Kind.EXPENSE,
+                date=date,
+                amount_cents=int(row["amount"] * 100),
+                description=(
+                    f"{description} - {row['note']}" if row["note"] else description
+                ),
+                payer=str(request.user.display_name),
+                category=row["category"],
+                subcategory=row["subcategory"],
+                account=account,
+            )
+            for row in rows
+        ]
+        # bulk_create skips the post_save signal that refreshes the quick picks
+        CategoryUsage.objects.bulk_create(
+            CategoryUsage(
+                user=request.user,
+                category=row["category"],
+                subcategory=row["subcategory"],
+            )
+            for row in rows
+        )
+        invalidate(QUICK_PICKS)
+
+        if record_transactions(transactions):
+            messages.add_message(
+                request,
+                messages.SUCCESS,
+                f"{len(transactions)} transazioni aggiunte con successo",
+            )
+        else:
+            messages.add_message(
+                request,
+                messages.WARNING,
+                "Transazioni salvate, ma non ancora sincronizzate con il foglio",
+            )
+        return HttpResponse(status=204, headers={"HX-Refresh": "true"})
+
+    context = {
+        "form": form,
+        "formset": formset,
+        "helper": ReceiptRowFormSetHelper(),
+    }
+    if request.htmx:
+        return TemplateResponse(request, "trantrac/receipt_form.html", context)
+    return TemplateResponse(request, "trantrac/receipt.html", context)
+
+
 def add_category(request):
     form = CategoryForm(request.POST or None)
     if form.is_valid():
@@ -127,19 +270,45 @@ def add_subcategory(request):
 
 @login_required
 def upload_csv(request):
+    """Parse uploaded bank exports and show what importing them would change.
+
+    The parsed rows and the preview are cached under the hash of the files, so
+    confirming the import doesn't upload or parse them again. Uploading the
+    same files again reuses the parse but recomputes the preview against the
+    ledger, which other imports may have changed since.
+    """
     if request.method == "POST":
         form = CsvUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            success, message = import_csv_to_sheet(
-                request.FILES["csv_file"], request.user
-            )
-            messages.add_message(
-                request,
-                messages.SUCCESS if success else messages.ERROR,
-                message,
-            )
-
-            return HttpResponse(status=204, headers={"HX-Redirect": reverse("index")})
+            files = [(file.name, file.read()) for file in form.cleaned_data["csv_file"]]
+            digest = hashlib.sha256()
+            for name, data in files:
+                digest.update(f"{name}:{len(data)}:".encode())
+                digest.update(data)
+            digest = digest.hexdigest()
+            key = import_preview_key(request.user, digest)
+            preview = cache.get(key)
+            if preview is None:
+                preview = preview_bank_files(files)
+            else:
+                preview = {**preview_import(preview["rows"]), "files": preview["files"]}
+            cache.set(key, preview, timeout=IMPORT_PREVIEW_TIMEOUT)
+            results = preview["files"]
+            if not results:
+                form.add_error("csv_file", "Nessun file CSV trovato nello zip")
+            elif len(results) == 1 and results[0][2]:
+                # A single file that can't be imported: report it on the form
+                form.add_error("csv_file", results[0][2])
+            else:
+                context = {
+                    "preview": preview,
+                    "digest": digest,
+                    "income_total": format_cents(preview["income_cents"]),
+                    "expense_total": format_cents(preview["expense_cents"]),
+                }
+                return TemplateResponse(
+                    request, "trantrac/upload_csv_preview.html", context
+                )
     else:
         form = CsvUploadForm()
 
@@ -150,11 +319,47 @@ def upload_csv(request):
         return TemplateResponse(request, "trantrac/upload_csv_page.html", context)
 
 
+@login_required
+@require_POST
+def confirm_csv_import(request):
+    """Write an import previewed by `upload_csv`, from its cached parse"""
+    digest = request.POST.get("digest", "")
+    key = import_preview_key(request.user, digest)
+    preview = cache.get(key) if IMPORT_DIGEST_RE.fullmatch(digest) else None
+    # Only the request that removes the preview imports it: a double submit
+    # can't write the rows twice
+    if preview is None or not cache.delete(key):
+        messages.add_message(
+            request,
+            messages.ERROR,
+            "Anteprima scaduta, carica di nuovo il file",
+        )
+    else:
+        success, message = apply_import(preview, request.user)
+        messages.add_message(
+            request,
+            messages.SUCCESS if success else messages.ERROR,
+            message,
+        )
+    return HttpResponse(status=204, headers={"HX-Redirect": reverse("index")})
+
+
+def import_preview_key(user, digest):
+    return f"import-preview:{user.pk}:{digest}"
+
+
 def load_subcategories(request):
-    category_id = request.GET.get("category")
+    try:
+        category_id = int(request.GET.get("category"))
+    except (TypeError, ValueError):
+        category_id = None
     if category_id:
-        subcategories = Subcategory.objects.filter(category_id=category_id).order_by(
-            "name"
+        subcategories = cached(
+            CATEGORIES,
+            f"subcategories:{category_id}",
+            lambda: list(
+                Subcategory.objects.filter(category_id=category_id).order_by("name")
+            ),
         )
     else:
         subcategories = Subcategory.objects.none()
@@ -163,6 +368,24 @@ def load_subcategories(request):
     )
 
 
+@login_required
+def predict_category(request):
+    prediction = None
+    description = request.GET.get("description", "")
+    if description.strip():
+        predictor = get_predictor()
+        predictor.refresh()
+        if label := predictor.predict(description):
+            category_id, subcategory_id = label
+            prediction = {
+                "category": Category.objects.filter(pk=category_id).first(),
+                "subcategory": Subcategory.objects.filter(pk=subcategory_id).first(),
+            }
+    return TemplateResponse(
+        request, "trantrac/category_prediction.html", {"prediction": prediction}
+    )
+
+
 @login_required
 def refresh_categories(request):
     sheet_data = get_sheet_data("CATEGORIE", "A2:B")
@@ -192,3 +415,327 @@ def refresh_categories(request):
         )
 
     return HttpResponse(status=204, headers={"HX-Redirect": reverse("index")})
+
+
+def parse_history_cursor(cursor):
+    """Parse a "<date>_<id>" keyset cursor, returning None when it is invalid"""
+    try:
+        date, pk = cursor.split("_")
+        return datetime.date.fromisoformat(date), int(pk)
+    except (AttributeError, ValueError):
+        return None
+
+
+@login_required
+def history(request):
+    """List recorded transactions, newest first, with keyset pagination.
+
+    Pages are addressed by the (date, id) of the last row shown instead of an
+    OFFSET, so every page is a bounded range scan on the (date, id),
+    (category, date) or (account, date) index whatever its position.
+    """
+    form = HistoryFilterForm(request.GET or None)
+    transactions = Transaction.objects.select_related(
+        "category", "subcategory", "account"
+    ).order_by("-date", "-id")
+
+    filters = {}
+    if form.is_valid():
+        transactions = filter_transactions(transactions, **form.cleaned_data)
+        filters = {
+            name: getattr(value, "pk", value)
+            for name, value in form.cleaned_data.items()
+            if value
+        }
+
+    if cursor := parse_history_cursor(request.GET.get("after")):
+        date, pk = cursor
+        # The date__lte bound lets SQLite seek into the index instead of
+        # walking it from the top and discarding the rows already shown
+        transactions = transactions.filter(date__lte=date).filter(
+            Q(date__lt=date) | Q(id__lt=pk)
+        )
+
+    page = list(transactions[: HISTORY_PAGE_SIZE + 1])
+    next_url = None
+    if len(page) > HISTORY_PAGE_SIZE:
+        page = page[:HISTORY_PAGE_SIZE]
+        last = page[-1]
+        next_url = "{}?{}".format(
+            reverse("history"),
+            urlencode({**filters, "after": f"{last.date.isoformat()}_{last.pk}"}),
+        )
+
+    context = {
+        "form": form if form.is_bound else HistoryFilterForm(),
+        "transactions": page,
+        "next_url": next_url,
+        "parquet_available": parquet_available(),
+    }
+    if request.htmx:
+        return TemplateResponse(request, "trantrac/history_rows.html", context)
+    return TemplateResponse(request, "trantrac/history.html", context)
+
+
+@login_required
+def export_transactions(request):
+    """Download the transactions matching the history filters as CSV or Parquet"""
+    form = HistoryFilterForm(request.GET)
+    transactions = Transaction.objects.all()
+    if form.is_valid():
+        transactions = filter_transactions(transactions, **form.cleaned_data)
+
+    if request.GET.get("format") == "parquet" and parquet_available():
+        # Parquet writes its footer last, so it is built in a temporary file
+        file = tempfile.TemporaryFile()  # noqa: SIM115 - closed by FileResponse
+        export_parquet(transactions, file)
+        file.seek(0)
+        return FileResponse(file, as_attachment=True, filename="transazioni.parquet")
+
+    return StreamingHttpResponse(
+        export_csv(transactions),
+        content_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="transazioni.csv"'},
+    )
+
+
+@login_required
+def search(request):
+    query = request.GET.get("q", "").strip()
+    results = search_transactions(query) if query else []
+    return TemplateResponse(
+        request, "trantrac/search_results.html", {"query": query, "results": results}
+    )
+
+
+def breakdown(totals):
+    """(label, amount, percentage of the largest) rows, largest first"""
+    largest = max(totals.values(), default=0) or 1
+    return [
+        (label, format_cents(cents), round(cents * 100 / largest))
+        for label, cents in totals.most_common()
+    ]
+
+
+@login_required
+def dashboard(request):
+    """Spending of the last months by month, category and account.
+
+    Every figure comes from the monthly rollups, one summary per month, so
+    the page costs the same with one year of history or twenty.
+    """
+    current = timezone.localdate().replace(day=1)
+    months = []
+    for _ in range(DASHBOARD_MONTHS):
+        months.append(current)
+        current = (current - datetime.timedelta(days=1)).replace(day=1)
+    summaries = [get_month_spending(month) for month in reversed(months)]
+
+    selected = None
+    try:
+        month = datetime.datetime.strptime(request.GET.get("month", ""), "%Y-%m")
+        selected = next(s for s in summaries if s["month"] == month.date())
+    except (ValueError, StopIteration):
+        pass
+
+    if selected:
+        categories, accounts = selected["categories"], selected["accounts"]
+    else:
+        categories, accounts = Counter(), Counter()
+        for summary in summaries:
+            categories.update(summary["categories"])
+            accounts.update(summary["accounts"])
+
+    largest_month = max(s["total_cents"] for s in summaries) or 1
+    context = {
+        "months": [
+            {
+                "month": summary["month"],
+                "total": format_cents(summary["total_cents"]),
+                "count": summary["count"],
+                "percentage": round(summary["total_cents"] * 100 / largest_month),
+                "selected": summary is selected,
+            }
+            for summary in summaries
+        ],
+        "selected": selected,
+        "total": format_cents(sum(categories.values())),
+        "categories": breakdown(categories),
+        "accounts": breakdown(accounts),
+    }
+    return TemplateResponse(request, "trantrac/dashboard.html", context)
+
+
+@login_required
+def category_map(request):
+    """Categories and their subcategories, for entry forms working offline"""
+    categories = cached(
+        CATEGORIES,
+        "map",
+        lambda: [
+            {
+                "id": category.pk,
+                "name": category.name,
+                "subcategories": [
+                    {"id": subcategory.pk, "name": subcategory.name}
+                    for subcategory in category.subcategory_set.all()
+                ],
+            }
+            for category in Category.objects.order_by("name").prefetch_related(
+                Prefetch("subcategory_set", Subcategory.objects.order_by("name"))
+            )
+        ],
+    )
+    return JsonResponse({"categories": categories})
+
+
+@login_required
+@require_POST
+def ingest_transactions(request):
+    """Record a batch of expenses queued by the offline client.
+
+    Each row carries a client-generated UUID stored as `client_id`: rows
+    already recorded are acknowledged as duplicates instead of being saved
+    again, so the client can safely resend a batch whose response was lost.
+    """
+    try:
+        rows = json.loads(request.body)["transactions"]
+    except (ValueError, KeyError, TypeError):
+        return JsonResponse({"error": "Richiesta non valida"}, status=400)
+    if not isinstance(rows, list) or len(rows) > INGEST_MAX_ROWS:
+        return JsonResponse({"error": "Richiesta non valida"}, status=400)
+    rows = [row for row in rows if isinstance(row, dict)]
+
+    def submitted_ids(field):
+        ids = set()
+        for row in rows:
+            try:
+                ids.add(int(row.get(field)))
+            except (TypeError, ValueError):
+                pass
+        return ids
+
+    lookups = {
+        "categories": Category.objects.in_bulk(submitted_ids("category")),
+        "subcategories": Subcategory.objects.in_bulk(submitted_ids("subcategory")),
+        "accounts": Account.objects.in_bulk(),
+    }
+    forms = [IngestTransactionForm(row, **lookups) for row in rows]
+    valid = [form.cleaned_data for form in forms if form.is_valid()]
+    recorded = set(
+        Transaction.objects.filter(
+            client_id__in=[data["id"] for data in valid]
+        ).values_list("client_id", flat=True)
+    )
+
+    results = []
+    new = {}
+    for form in forms:
+        if not form.is_valid():
+            results.append(
+                {"id": form.data.get("id"), "status": "invalid", "errors": form.errors}
+            )
+        elif form.cleaned_data["id"] in recorded or form.cleaned_data["id"] in new:
+            results.append({"id": form.data["id"], "status": "duplicate"})
+        else:
+            new[form.cleaned_data["id"]] = form.cleaned_data
+            results.append({"id": form.data["id"], "status": "created"})
+
+    synced = True
+    if new:
+        account = default_account(request.user)
+        transactions = [
+            Transaction(
+                user=request.user,
+                kind=Transaction.Kind.EXPENSE,
+                date=data["date"],
+                amount_cents=int(data["amount"] * 100),
+                description=data["description"],
+                payer=str(request.user.display_name),
+                category=data["category"],
+                subcategory=data["subcategory"],
+                account=data["bank_account"] or account,
+                client_id=client_id,
+            )
+            for client_id, data in new.items()
+        ]
+        try:
+            synced = record_transactions(transactions)
+        except IntegrityError:
+            # Another request recorded some of these rows first: let the
+            # client retry, the next attempt will see them as duplicates
+            return JsonResponse({"error": "Riprova"}, status=409)
+        CategoryUsage.objects.bulk_create(
+            CategoryUsage(
+                user=request.user,
+                category=data["category"],
+                subcategory=data["subcategory"],
+            )
+            for data in new.values()
+        )
+        invalidate(QUICK_PICKS)
+
+    return JsonResponse({"results": results, "synced": synced})
+
+
+@never_cache
+def healthz(request):
+    """Liveness: the worker answers, without touching the database or Google"""
+    return JsonResponse({"status": "ok", "uptime_s": uptime()})
+
+
+@never_cache
+def readyz(request):
+    """Readiness: database write lock, Sheets probe, outbox depth and uptime.
+
+    503 only when the database can't be written: with Sheets down the app
+    still works and the entries wait in the outbox. The endpoint is public, so
+    only staff see the report; anybody else gets "ok" or "fail".
+    """
+    ready, report = readiness()
+    if not request.user.is_staff:
+        report = {"status": "ok" if ready else "fail"}
+    return JsonResponse(report, status=200 if ready else 503)
+
+
+@staff_member_required
+def profiles(request):
+    """Recent request profiles, see trantrac.profiling"""
+    context = {
+        "profiles": RequestProfile.objects.select_related("user").defer("report")[:50],
+        "profile_param": PROFILE_PARAM,
+    }
+    return TemplateResponse(request, "trantrac/profiles.html", context)
+
+
+@staff_member_required
+def profile_detail(request, pk):
+    profile = get_object_or_404(RequestProfile.objects.select_related("user"), pk=pk)
+    return TemplateResponse(
+        request, "trantrac/profile_detail.html", {"profile": profile}
+    )
+
+
+def service_worker(request):
+    """Serve the service worker from the site root, so its scope covers every page.
+
+    The cache name is derived from the (hashed) asset URLs: a deploy that
+    changes any of them changes this script, and browsers install the new
+    worker, which drops the old cache.
+    """
+    assets = [static(path) for path in OFFLINE_ASSETS]
+    version = hashlib.sha256("\n".join(assets).encode()).hexdigest()[:12]
+    context = {
+        "version": version,
+        "assets": json.dumps(assets),
+        "index_url": json.dumps(reverse("index")),
+        "category_map_url": json.dumps(reverse("category_map")),
+        "subcategories_url": json.dumps(reverse("load_subcategories")),
+    }
+    return TemplateResponse(
+        request,
+        "trantrac/sw.js",
+        context,
+        content_type="application/javascript",
+        headers={"Cache-Control": "no-cache"},
+    )